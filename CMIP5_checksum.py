@@ -0,0 +1,422 @@
+# Checksum helpers for fetch_step2.py
+#
+# Checksums of the files on the tree are kept in a sqlite database (by default ~/.CMIP5_checksum_cache.db),
+# so files that were already hashed by a previous run don't need to be read again.
+# Each entry is keyed on the file path and the checksum type (md5 or sha256) and stores the file size,
+# modification time and inode at the time it was hashed: if any of these changed the entry is stale,
+# the file is hashed again and its entry replaced.
+# The cache keeps at most max_entries rows, when it grows bigger the least recently used entries are evicted.
+# Each entry also stores a fingerprint of the file: the md5 of its first and last fingerprint_size bytes.
+# cache_quick uses it to accept the cached checksum of a file whose mtime or inode changed (for example copied again
+# by the tree synchronisation) without reading the whole file, if its size and fingerprint are still the same.
+# The cache is opened separately by each process, so it can be used from multiprocessing workers. Workers only read it:
+# new checksums (cache_put) and the time entries were last used (cache_touch) are written in batches of flush_size
+# rows in one transaction, call cache_flush to write the last ones, so the processes sharing the cache hold its lock
+# only once for each batch. The cache is shared by the shards of a run on different nodes through the home directory,
+# the database keeps the rollback journal because a write-ahead log works only for processes on the same host and
+# not on a network filesystem.
+#
+# Files are hashed in-process with hashlib instead of calling md5sum/sha256sum on each file.
+# hash_file reads the file in large blocks (a multiple of the 1MB Lustre stripe size) with a second thread
+# reading the next block while the current one is hashed. hash_files hashes several files at the same time
+# on a pool of threads, this works because hashlib and file reads release the GIL.
+# The files are not hashed in the order given: they are split in small and large (bigger than large_size) files and
+# each group is sorted by directory, so the files of a directory are read one after the other. At most max_large
+# large files are read at the same time, by default half the threads, the other threads keep hashing small files.
+# A rate in bytes/s can be passed to limit the total reading speed of all the threads, to be nice to the shared filesystem.
+# hash_stats keeps count of files and bytes hashed, hash_report() returns it as a string with the throughput.
+#
+# Run as a script it fully hashes the files listed in a deferred file written by fetch_step2.py --quick --defer,
+# as a low priority process, and lists the files whose checksum is different from the one accepted by the quick check:
+#
+#    python CMIP5_checksum.py deferred.csv
+
+import os, sys, sqlite3, time, hashlib, threading, subprocess, argparse
+import Queue
+from collections import deque
+
+cache_file = os.path.expanduser('~/.CMIP5_checksum_cache.db')
+max_entries = 1000000
+# sqlite connection and process that opened it
+_conn = None
+_conn_pid = None
+# bytes read from the start and the end of a file for its fingerprint
+fingerprint_size = 1024 * 1024
+# rows waiting to be written by cache_flush, new checksums and (used, path, hash_type) of the entries used
+flush_size = 1000
+_puts = []
+_used = []
+
+
+def open_cache(dbfile, maxsize=1000000):
+    ''' Set the cache database file and the maximum number of entries, None dbfile disables the cache '''
+    global cache_file, max_entries, _conn
+    cache_file = dbfile
+    max_entries = maxsize
+    _conn = None
+    return
+
+
+def _cache_conn():
+    ''' Return a connection to the cache database for the current process, creating the table if needed '''
+    global _conn, _conn_pid
+    if _conn is None or _conn_pid != os.getpid():
+       _conn = sqlite3.connect(cache_file, timeout=60)
+       _conn_pid = os.getpid()
+# a cache converted to a write-ahead log by an earlier version goes back to the rollback journal
+       _conn.execute("PRAGMA journal_mode=DELETE")
+       _conn.execute('''CREATE TABLE IF NOT EXISTS checksums
+             (path text, hash_type text, size integer, mtime real, inode integer, digest text, used real,
+              fingerprint text, PRIMARY KEY (path, hash_type))''')
+       _conn.execute("CREATE INDEX IF NOT EXISTS checksums_used ON checksums(used)")
+# caches created before fingerprints were added don't have the column
+       if 'fingerprint' not in [row[1] for row in _conn.execute("PRAGMA table_info(checksums)")]:
+          _conn.execute("ALTER TABLE checksums ADD COLUMN fingerprint text")
+       _conn.commit()
+    return _conn
+
+
+def file_key(path):
+    ''' Return the (size, mtime, inode) of a file, used to check if a cache entry is still valid '''
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime, st.st_ino)
+
+
+def _fingerprint(head, tail):
+    ''' Return the md5 of the first and last bytes of a file '''
+    h = hashlib.md5()
+    h.update(head)
+    h.update(tail)
+    return h.hexdigest()
+
+
+def fingerprint(path):
+    ''' Return the md5 of the first and last fingerprint_size bytes of a file, the last ones only if they
+        don't overlap the first ones '''
+    f = open(path, 'rb')
+    try:
+        head = f.read(fingerprint_size)
+        tail = ''
+        size = os.fstat(f.fileno()).st_size
+        if size > fingerprint_size:
+           f.seek(max(fingerprint_size, size - fingerprint_size))
+           tail = f.read(fingerprint_size)
+    finally:
+        f.close()
+    return _fingerprint(head, tail)
+
+
+def cache_get(path, hash_type, key):
+    ''' Return the cached checksum for the file if its size, mtime and inode are still the ones in key, otherwise None.
+        It doesn't write to the cache, call cache_touch if the checksum is used '''
+    if not cache_file: return None
+    row = _cache_conn().execute("SELECT size, mtime, inode, digest FROM checksums WHERE path=? AND hash_type=?",
+                                (path, hash_type.lower())).fetchone()
+    if row is None or tuple(row[0:3]) != tuple(key):
+       return None
+    return row[3]
+
+
+def cache_quick(path, hash_type, key):
+    ''' Return the cached checksum for a file whose mtime or inode changed since it was hashed if its size and
+        fingerprint are still the same, otherwise None. The mtime and inode of the entry are not updated, so the file
+        is checked again by the next run until it is fully hashed. As cache_get it doesn't write to the cache '''
+    if not cache_file: return None
+    row = _cache_conn().execute("SELECT size, fingerprint, digest FROM checksums WHERE path=? AND hash_type=?",
+                                (path, hash_type.lower())).fetchone()
+    if row is None or row[0] != key[0] or not row[1]:
+       return None
+# a file that can't be read is left to be hashed, which reports the error
+    try:
+        if fingerprint(path) != row[1]:
+           return None
+    except (IOError, OSError):
+        return None
+    return row[2]
+
+
+def cache_touch(path, hash_type):
+    ''' Record that the cached checksum of the file was used, so it is evicted after the ones not used '''
+    if not cache_file: return
+    _used.append((time.time(), path, hash_type.lower()))
+    if len(_used) >= flush_size: cache_flush()
+    return
+
+
+def cache_put(path, hash_type, key, digest, fprint=None):
+    ''' Add the checksum and the fingerprint of the file to the cache, replacing a stale entry,
+        key is the (size, mtime, inode) of the file before hashing it '''
+    if not cache_file: return
+    _puts.append((path, hash_type.lower()) + tuple(key) + (digest, time.time(), fprint))
+    if len(_puts) >= flush_size: cache_flush()
+    return
+
+
+def cache_flush():
+    ''' Write the checksums added and the entries used since the last flush, in one transaction '''
+    global _puts, _used
+    if not cache_file or not (_puts or _used): return
+    conn = _cache_conn()
+    with conn:
+        conn.executemany('''INSERT OR REPLACE INTO checksums (path, hash_type, size, mtime, inode, digest, used, fingerprint)
+                         VALUES (?,?,?,?,?,?,?,?)''', _puts)
+        conn.executemany("UPDATE checksums SET used=? WHERE path=? AND hash_type=?", _used)
+    _puts = []
+    _used = []
+    return
+
+
+def evict_cache():
+    ''' If the cache has more than max_entries rows delete the least recently used, down to 90% of max_entries.
+        Return the number of entries evicted '''
+    if not cache_file: return 0
+    cache_flush()
+    conn = _cache_conn()
+    nrows = conn.execute("SELECT count(*) FROM checksums").fetchone()[0]
+    if nrows <= max_entries:
+       return 0
+    nevict = nrows - int(max_entries * 0.9)
+    with conn:
+        conn.execute("DELETE FROM checksums WHERE rowid IN (SELECT rowid FROM checksums ORDER BY used LIMIT ?)", (nevict,))
+    return nevict
+
+
+# size of the blocks read from each file, files smaller than this are read in one go without a read-ahead thread
+blocksize = 4 * 1024 * 1024
+# files bigger than this are large reads, limited to max_large at the same time by hash_files
+large_size = 512 * 1024 * 1024
+# counters updated by hash_files
+hash_stats = {'files': 0, 'bytes': 0, 'errors': 0, 'seconds': 0.0}
+
+
+def hash_name(hash_type):
+    ''' Return the hashlib name of the checksum type as found in the wget file: MD5, md5, SHA256 or sha256 '''
+    if hash_type.lower() == 'sha256': return 'sha256'
+    return 'md5'
+
+
+class Throttle(object):
+    ''' Limit the bytes read by all the threads sharing it to rate bytes/s '''
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.lock = threading.Lock()
+        self.until = time.time()
+
+    def wait(self, nbytes):
+        ''' Sleep until the nbytes just read are within the rate, each read is queued after the previous ones '''
+        with self.lock:
+            now = time.time()
+            self.until = max(self.until, now) + nbytes / self.rate
+            delay = self.until - now
+        if delay > 0: time.sleep(delay)
+
+
+def _read_ahead(f, free, full, throttle=None):
+    ''' Read the file in the buffers taken from the free queue and put them in the full queue with the number
+        of bytes read, 0 bytes means end of file. Errors are passed on to be raised by the hashing thread '''
+    try:
+        while True:
+            buf = free.get()
+            n = f.readinto(buf)
+            if throttle and n: throttle.wait(n)
+            full.put((buf, n))
+            if not n: break
+    except Exception as e:
+        full.put((e, 0))
+
+
+def hash_file(path, hash_type, throttle=None, fprint=False):
+    ''' Return the md5/sha256 checksum of a file, its size in bytes and, if fprint is True, its fingerprint
+        (the same as fingerprint(path), calculated from the blocks read), otherwise None.
+        The next block is read while the current one is hashed. If a Throttle is passed, reading waits to keep within its rate '''
+    h = hashlib.new(hash_name(hash_type))
+    nbytes = 0
+    head = None
+    tail = ''
+    f = open(path, 'rb', 0)
+    try:
+        if os.fstat(f.fileno()).st_size <= blocksize:
+           data = f.read()
+           if throttle and data: throttle.wait(len(data))
+           h.update(data)
+           if not fprint: return h.hexdigest(), len(data), None
+           return h.hexdigest(), len(data), _fingerprint(data[:fingerprint_size],
+                                                         data[max(fingerprint_size, len(data) - fingerprint_size):])
+# two buffers are used: one is filled by the reader thread while the other is hashed
+        free = Queue.Queue()
+        full = Queue.Queue()
+        for i in range(2):
+            free.put(bytearray(blocksize))
+        reader = threading.Thread(target=_read_ahead, args=(f, free, full, throttle))
+        reader.daemon = True
+        reader.start()
+        while True:
+            buf, n = full.get()
+            if isinstance(buf, Exception): raise buf
+            if not n: break
+            h.update(buffer(buf, 0, n))
+# files this big are longer than two fingerprint blocks, the tail is the last fingerprint_size bytes read
+            if fprint:
+               if head is None: head = str(buffer(buf, 0, min(n, fingerprint_size)))
+               tail = (tail + str(buffer(buf, max(0, n - fingerprint_size), min(n, fingerprint_size))))[-fingerprint_size:]
+            nbytes += n
+            free.put(buf)
+        reader.join()
+    finally:
+        f.close()
+    if not fprint: return h.hexdigest(), nbytes, None
+    return h.hexdigest(), nbytes, _fingerprint(head or '', tail)
+
+
+def schedule(jobs):
+    ''' Split the jobs (key, path, checksum type[, size]) in small and large files, each sorted by directory and file name.
+        The size is read from the file if not given. Return two deques of (key, path, checksum type) '''
+    small = []
+    large = []
+    for job in jobs:
+        key, path, hash_type = job[0:3]
+        if len(job) > 3:
+           size = job[3]
+        else:
+           try:
+               size = os.path.getsize(path)
+           except OSError:
+               size = 0
+        if size > large_size:
+           large.append((key, path, hash_type))
+        else:
+           small.append((key, path, hash_type))
+    order = lambda job: os.path.split(job[1])
+    return deque(sorted(small, key=order)), deque(sorted(large, key=order))
+
+
+def _next_job(small, large, slots):
+    ''' Return the next job to hash and True if it holds a large read slot, (None, False) when there are no jobs left.
+        A large file is taken when a slot is free, otherwise a small one '''
+    while True:
+        if slots.acquire(False):
+           try:
+               return large.popleft(), True
+           except IndexError:
+               slots.release()
+        try:
+            return small.popleft(), False
+        except IndexError:
+            pass
+        if not large: return None, False
+# only large files are left and all the slots are busy, wait for one to be released
+        slots.acquire()
+        slots.release()
+
+
+def _hash_worker(small, large, slots, throttle, fprint, results):
+    ''' Hash the files in the small and large queues until both are empty, put (key, checksum, bytes, fingerprint)
+        in the results queue, checksum is None if the file couldn't be read '''
+    while True:
+        job, slot = _next_job(small, large, slots)
+        if job is None: break
+        key, path, hash_type = job
+        try:
+            digest, nbytes, fp = hash_file(path, hash_type, throttle, fprint)
+        except (IOError, OSError) as e:
+            print "Error reading " + path + ": " + str(e)
+            digest, nbytes, fp = None, 0, None
+        if slot: slots.release()
+        results.put((key, digest, nbytes, fp))
+
+
+def hash_files(jobs, nthreads=4, max_large=None, rate=None, fprint=False):
+    ''' Hash the files listed in jobs as (key, path, checksum type[, size]) on nthreads threads, reading at most max_large
+        large files at the same time (default half the threads) and at most rate bytes/s if given.
+        Yield (key, checksum, bytes, fingerprint) for each file as soon as it is done, fingerprint is None
+        unless fprint is True '''
+    small, large = schedule(jobs)
+    results = Queue.Queue()
+    njobs = len(small) + len(large)
+    slots = threading.Semaphore(max_large or max(1, nthreads // 2))
+    throttle = None
+    if rate: throttle = Throttle(rate)
+    threads = []
+    for i in range(min(nthreads, njobs)):
+        t = threading.Thread(target=_hash_worker, args=(small, large, slots, throttle, fprint, results))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    t0 = time.time()
+    for i in range(njobs):
+        key, digest, nbytes, fp = results.get()
+        hash_stats['files'] += 1
+        hash_stats['bytes'] += nbytes
+        if digest is None: hash_stats['errors'] += 1
+        yield key, digest, nbytes, fp
+    hash_stats['seconds'] += time.time() - t0
+    for t in threads:
+        t.join()
+
+
+def hash_report():
+    ''' Return a summary of hash_stats, including the hashing throughput '''
+    rate = 0.0
+    if hash_stats['seconds'] > 0: rate = hash_stats['bytes'] / hash_stats['seconds']
+    return "Hashed %d files, %.1f MB in %.2f s (%.1f MB/s), %d errors" % (hash_stats['files'],
+           hash_stats['bytes'] / 1e6, hash_stats['seconds'], rate / 1e6, hash_stats['errors'])
+
+
+def low_priority():
+    ''' Lower the cpu and, if ionice is available, the I/O priority of this process '''
+    os.nice(19)
+    try:
+        subprocess.call(['ionice', '-c', '3', '-p', str(os.getpid())])
+    except OSError:
+        pass
+
+
+def verify_deferred(dfile, nthreads=4, max_large=None, rate=None):
+    ''' Fully hash the files listed in the deferred file as path,checksum type,checksum and update the cache.
+        Return the list of files whose checksum is different '''
+    jobs = {}
+    for line in open(dfile, 'r'):
+        path, hash_type, digest = line.rstrip("\n").split(",")
+        jobs[path] = (hash_type, digest)
+    failed = []
+    for path, digest, nbytes, fp in hash_files([(p, p, jobs[p][0]) for p in jobs], nthreads, max_large, rate,
+                                               bool(cache_file)):
+        if digest is not None:
+           cache_put(path, jobs[path][0], file_key(path), digest, fp)
+        if digest != jobs[path][1]:
+           failed.append(path)
+    cache_flush()
+    return failed
+
+
+def parse_input():
+    ''' Parse input arguments '''
+    parser = argparse.ArgumentParser(description='''Fully hashes, as a low priority process, the files accepted
+             by the quick check of fetch_step2.py and listed in its deferred file''')
+    parser.add_argument('deferred', type=str, help='deferred file written by fetch_step2.py --defer')
+    parser.add_argument('--threads', type=int, default=4, help='number of threads, default 4', required=False)
+    parser.add_argument('--max-rate', type=float, default=None, help='''maximum total reading speed in MB/s,
+                        default is no limit''', required=False)
+    parser.add_argument('--cache', type=str, default=cache_file, help='''sqlite file of the checksum cache,
+                        default is ~/.CMIP5_checksum_cache.db''', required=False)
+    return vars(parser.parse_args())
+
+
+def main():
+    ''' Verify the files of a deferred file '''
+    args = parse_input()
+    low_priority()
+    open_cache(args["cache"])
+    rate = None
+    if args["max_rate"]: rate = args["max_rate"] * 1e6
+    failed = verify_deferred(args["deferred"], args["threads"], None, rate)
+    print hash_report()
+    for path in failed:
+        print "Checksum different from the quick check: " + path
+    print "%d files different from the quick check" % len(failed)
+    if failed: sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
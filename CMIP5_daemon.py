@@ -0,0 +1,180 @@
+# Resident query service for the list of files on the replica tree
+#
+# search_CMIP5_replica.py and CMIP5_replica_db.py read and parse the whole weekly file list for every query.
+# This service reads it once, keeps the unique ensembles in memory with an index for each field, and answers
+# constraint queries over local HTTP. It checks the modification time of the file list every --interval seconds
+# and reloads it when it changes, queries keep being answered from the old index until the new one is ready.
+#
+# Start the service (it can be left running, for example in screen, on the login node used by the group):
+#
+#    python CMIP5_daemon.py -p 8770
+#
+# and pass its url to the scripts with -s/--server, they return the same output as scanning the file list:
+#
+#    python search_CMIP5_replica.py -s http://localhost:8770 -v tas -e historical output.csv
+#    python CMIP5_replica_db.py -s http://localhost:8770 -v tas -e historical
+#
+# If the service can't be reached the scripts print a warning and scan the file list as usual.
+# The service can be queried directly too, each line of the response is a matching ensemble:
+#    http://localhost:8770/query?variable=tas&experiment=historical&frequency=mon
+#    http://localhost:8770/status   returns the file list loaded, its modification time and number of ensembles
+
+import os, time, json, threading, urllib, urllib2, urlparse, argparse
+import BaseHTTPServer, SocketServer
+from CMIP5_parser import select_ensembles, read_paths, frequency_tables
+from CMIP5_parser import VAR, MIP, MODEL, EXP
+
+# query parameters and the position of the field they select
+fields = {'variable': VAR, 'mip_table': MIP, 'model': MODEL, 'experiment': EXP}
+timeout = 60
+
+
+class ReplicaIndex(object):
+    ''' Unique records (variable, mip, model, experiment, ensemble, version, path) of the file list in the order found,
+        with an index {value: list of record positions} for each constrained field '''
+
+    def __init__(self, infile):
+        self.infile = infile
+        self.mtime = os.path.getmtime(infile)
+        t0 = time.time()
+        self.records = []
+        self.postings = dict((pos, {}) for pos in fields.values())
+        found = set()
+        inf = open(infile, 'r')
+        for rec in select_ensembles(read_paths(inf), []):
+            if rec in found: continue
+            found.add(rec)
+            for pos, index in self.postings.items():
+                index.setdefault(rec[pos], []).append(len(self.records))
+            self.records.append(rec)
+        inf.close()
+        self.seconds = time.time() - t0
+
+    def query(self, cons):
+        ''' Return the records matching the constraints, a list of (field position, values), in file order '''
+        selected = None
+# intersect the positions of each field starting from the most selective one
+        matches = []
+        for pos, values in cons:
+            index = self.postings[pos]
+            matches.append(set().union(*[index.get(v, []) for v in values]))
+        for ids in sorted(matches, key=len):
+            if selected is None:
+               selected = ids
+            else:
+               selected = selected & ids
+            if not selected: return []
+        if selected is None:
+           return list(self.records)
+        return [self.records[i] for i in sorted(selected)]
+
+
+def query_constraints(params):
+    ''' Convert the query parameters {name: [values]} to a list of (field position, values),
+        frequency adds the correspondent mip tables '''
+    values = dict((pos, set()) for pos in fields.values())
+    for name, pos in fields.items():
+        values[pos].update(params.get(name, []))
+    for frq in params.get('frequency', []):
+        values[MIP].update(frequency_tables.get(frq, []))
+    return [(pos, frozenset(v)) for pos, v in values.items() if v]
+
+
+class QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' Answer /query and /status requests using the index of the server '''
+
+    def do_GET(self):
+        parts = urlparse.urlsplit(self.path)
+        index = self.server.index
+        if parts.path == '/query':
+           cons = query_constraints(urlparse.parse_qs(parts.query))
+           body = ''.join([','.join(rec) + '\n' for rec in index.query(cons)])
+           ctype = 'text/plain'
+        elif parts.path == '/status':
+           body = json.dumps({'file_list': index.infile, 'mtime': index.mtime,
+                              'ensembles': len(index.records), 'load_seconds': index.seconds})
+           ctype = 'application/json'
+        else:
+           self.send_error(404)
+           return
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+           BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class QueryServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    ''' HTTP server answering each request on a new thread, holding the index of the file list '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, infile, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, QueryHandler)
+        self.verbose = verbose
+        self.index = ReplicaIndex(infile)
+
+    def watch(self, interval):
+        ''' Reload the file list every time its modification time changes, checking every interval seconds '''
+        while True:
+            time.sleep(interval)
+            try:
+                if os.path.getmtime(self.index.infile) == self.index.mtime: continue
+# the new index replaces the old one only when complete
+                self.index = ReplicaIndex(self.index.infile)
+                print "Reloaded %s: %d ensembles in %.1f s" % (self.index.infile,
+                      len(self.index.records), self.index.seconds)
+            except (IOError, OSError) as e:
+                print "Error reloading file list: " + str(e)
+
+
+def query_server(url, var0, mod0, exp0, mip0):
+    ''' Return the records matching the constraints from the service at url,
+        raises IOError if the service can't be reached '''
+    params = [('variable', v) for v in var0] + [('model', m) for m in mod0]
+    params += [('experiment', e) for e in exp0] + [('mip_table', t) for t in mip0]
+    try:
+        resp = urllib2.urlopen(url.rstrip('/') + '/query?' + urllib.urlencode(params), timeout=timeout)
+        body = resp.read()
+    except urllib2.URLError as e:
+        raise IOError(str(e))
+    return [tuple(line.split(',')) for line in body.splitlines()]
+
+
+def parse_input():
+    ''' Parse input arguments '''
+    parser = argparse.ArgumentParser(description='''Keeps the list of files on the replica tree in memory
+             and answers queries from search_CMIP5_replica.py and CMIP5_replica_db.py run with -s/--server''')
+    parser.add_argument('-i','--input', type=str, default='/g/data1/ua6/unofficial-ESG-replica/tmp/tree/esg-tree-LATEST-paths.txt',
+                        help='file list, default is the weekly list of files on the tree', required=False)
+    parser.add_argument('-p','--port', type=int, default=8770, help='port to listen on, default 8770', required=False)
+    parser.add_argument('--host', type=str, default='localhost', help='''address to listen on, default localhost
+                        so only users of the same node can query the service''', required=False)
+    parser.add_argument('--interval', type=int, default=60, help='''seconds between checks for changes
+                        of the file list, default 60''', required=False)
+    parser.add_argument('--verbose', action='store_true', default=False, help='log each request', required=False)
+    return vars(parser.parse_args())
+
+
+def main():
+    ''' Load the file list and serve queries until interrupted '''
+    args = parse_input()
+    server = QueryServer((args["host"], args["port"]), args["input"], args["verbose"])
+    print "Loaded %s: %d ensembles in %.1f s" % (args["input"], len(server.index.records), server.index.seconds)
+    watcher = threading.Thread(target=server.watch, args=(args["interval"],))
+    watcher.daemon = True
+    watcher.start()
+    print "Serving on http://%s:%d" % (args["host"], args["port"])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+# Client for the ESGF search service (esg-search), used by fetch_step1.py
+#
+# Queries for different experiments are run at the same time on a bounded pool of threads,
+# each thread keeps its HTTP connection to the node open between requests (keep-alive).
+# Requests that fail with a network error or a 5xx/429 response are retried, waiting twice as long
+# after each failed attempt.
+# The wget endpoint returns at most "limit" files per request: fetch_wget first asks the search
+# endpoint how many files match the query, then requests the wget script page by page using "offset",
+# until all the files have been retrieved (ESGFError is raised if the node stops sending files before that).
+# The file lines of the following pages are added to the script returned with the first page, so the result
+# is a single wget script listing all the files.
+# The node can be one of the known nodes (dkrz, pcmdi) or the url of any esg-search service,
+# for example a local test server: http://localhost:8000/esg-search/
+#
+# search_records is an alternative to the wget scripts: it queries the search endpoint for File records
+# in json format and returns for each file: filename, url, checksum, checksum type, size and version.
+# write_records/read_records save them as a csv file (files_<experiment>.csv) that fetch_step2.py loads directly.
+# The query is split in one query for each variable_cmip-table (and model if models are passed), so a
+# different combination of the same variables/models reuses the results already retrieved.
+# Responses of the search endpoint are cached in cache_dir, as gzipped json named after the sha1 of the
+# request url; a cached response is used if it is younger than ttl seconds.
+
+import csv, gzip, hashlib, json, os, socket, threading, time, urllib
+import httplib, urlparse
+from multiprocessing.pool import ThreadPool
+
+nodes = {'dkrz': 'http://esgf-data.dkrz.de/esg-search/',
+         'pcmdi': 'http://pcmdi.llnl.gov/esg-search/'}
+# marker of the end of the list of files in the wget script
+files_end = 'EOF--dataset.file.url.chksum_type.chksum'
+no_files = 'No files were found that matched the query'
+# number of attempts for each request, first retry waits backoff seconds
+retries = 5
+backoff = 1.0
+timeout = 300
+# open connections of each thread, one for each (scheme, host)
+_local = threading.local()
+# directory and validity in seconds of cached search responses, None cache_dir disables the cache
+cache_dir = os.path.expanduser('~/.CMIP5_esgf_cache')
+ttl = 86400
+# fields of the file records
+record_fields = ['filename', 'url', 'checksum', 'checksum_type', 'size', 'version']
+
+
+class ESGFError(Exception):
+    ''' Raised when a request to the ESGF node still fails after all the retries, or the node is unknown '''
+    pass
+
+
+def node_url(node):
+    ''' Return the esg-search url for the node, which can be a known node name or an url '''
+    if node.startswith('http://') or node.startswith('https://'):
+       if not node.endswith('/'): node += '/'
+       return node
+    if node not in nodes:
+       raise ESGFError("Unknown node " + node + ", known nodes are " + ", ".join(sorted(nodes)) +
+                       " or the url of an esg-search service")
+    return nodes[node]
+
+
+def query_params(exp, modlist, varlist, miplist):
+    ''' Return the list of (parameter, value) pairs for a query on experiment, models, variables and cmip tables '''
+    params = [('experiment', exp)]
+    params += [('cmor_table', mip) for mip in miplist]
+    params += [('project', 'CMIP5')]
+    params += [('model', mod) for mod in modlist]
+    params += [('variable', var) for var in varlist]
+    params += [('replica', 'false'), ('latest', 'true')]
+    return params
+
+
+def _connection(scheme, host):
+    ''' Return the connection to host opened by the current thread, opening a new one if needed '''
+    if not hasattr(_local, 'conns'): _local.conns = {}
+    conn = _local.conns.get((scheme, host))
+    if conn is None:
+       if scheme == 'https':
+          conn = httplib.HTTPSConnection(host, timeout=timeout)
+       else:
+          conn = httplib.HTTPConnection(host, timeout=timeout)
+       _local.conns[(scheme, host)] = conn
+    return conn
+
+
+def http_get(url):
+    ''' Return the body of the response to a GET request to url, retrying on transient errors '''
+    parts = urlparse.urlsplit(url)
+    path = parts.path
+    if parts.query: path += '?' + parts.query
+    wait = backoff
+    for attempt in range(retries):
+        conn = _connection(parts.scheme, parts.netloc)
+        try:
+            conn.request('GET', path, headers={'Connection': 'keep-alive'})
+            resp = conn.getresponse()
+            body = resp.read()
+            if resp.status == 200:
+               return body
+            error = "HTTP error %d %s" % (resp.status, resp.reason)
+            if resp.status < 500 and resp.status != 429:
+               raise ESGFError(error + " for " + url)
+        except (socket.error, httplib.HTTPException) as e:
+            error = str(e) or e.__class__.__name__
+# the connection can't be reused after an error, it will be opened again
+            conn.close()
+            del _local.conns[(parts.scheme, parts.netloc)]
+        if attempt < retries - 1:
+           print "Request failed (%s), retrying in %.0f s" % (error, wait)
+           time.sleep(wait)
+           wait *= 2
+    raise ESGFError(error + " for " + url + " after %d attempts" % retries)
+
+
+def count_files(base, params):
+    ''' Return the number of files matching the query, using the search endpoint '''
+    url = base + 'search?' + urllib.urlencode(params + [('type', 'File'), ('limit', '0'),
+                                                        ('format', 'application/solr+json')])
+    return json.loads(http_get(url))['response']['numFound']
+
+
+def file_lines(script):
+    ''' Return the list of file lines in a wget script, these start with a quote '''
+    return [line for line in script.splitlines(True) if line.startswith("'")]
+
+
+def fetch_wget(base, params, limit=10000):
+    ''' Return a wget script listing all the files matching the query, requesting it in pages of limit files '''
+    nfiles = count_files(base, params)
+    if nfiles == 0:
+       return no_files
+    script = None
+    extra = []
+    offset = 0
+    while offset < nfiles:
+        url = base + 'wget?' + urllib.urlencode(params + [('limit', str(limit)), ('offset', str(offset))])
+        page = http_get(url)
+        lines = file_lines(page)
+# the node can return less files than limit, move on by the number of files received
+        if not lines: break
+        if script is None:
+           script = page
+        else:
+           extra.extend(lines)
+        offset += len(lines)
+# a node that stops sending files before the count would otherwise drop the rest silently
+    if offset < nfiles:
+       raise ESGFError("Only %d of %d files were returned for %s" % (offset, nfiles,
+                       base + 'wget?' + urllib.urlencode(params)))
+# add the files from the following pages to the list in the first script
+    if extra:
+       pos = script.find('\n' + files_end) + 1
+       script = script[:pos] + ''.join(extra) + script[pos:]
+    return script
+
+
+def fetch_all(tasks, nthreads=4, func=fetch_wget):
+    ''' Run func (default fetch_wget) for each task (tuple of arguments) on nthreads threads,
+        return the results in the same order as the tasks '''
+    if not tasks: return []
+    pool = ThreadPool(min(nthreads, len(tasks)))
+    try:
+        return pool.map(lambda task: func(*task), tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def cached_get(url):
+    ''' Return the body of the response to url from the cache if it is younger than ttl, otherwise request it
+        and save it in the cache '''
+    if not cache_dir:
+       return http_get(url)
+    cfile = os.path.join(cache_dir, hashlib.sha1(url).hexdigest() + '.json.gz')
+    try:
+        if time.time() - os.path.getmtime(cfile) < ttl:
+           f = gzip.open(cfile, 'rb')
+           try:
+               return f.read()
+           finally:
+               f.close()
+    except (IOError, OSError):
+        pass
+    body = http_get(url)
+    if not os.path.isdir(cache_dir):
+       try:
+           os.makedirs(cache_dir)
+       except OSError:
+           pass
+# write to a temporary file first, so other processes never read a partial response
+    tmp = cfile + '.%d.%s' % (os.getpid(), threading.current_thread().name)
+    f = gzip.open(tmp, 'wb')
+    f.write(body)
+    f.close()
+    os.rename(tmp, cfile)
+    return body
+
+
+def doc_record(doc):
+    ''' Return a record (filename, url, checksum, checksum type, size, version) from a solr File document '''
+# urls are listed as "url|mime type|service", use the HTTPServer one
+    url = ''
+    for u in doc.get('url', []):
+        bits = u.split('|')
+        if len(bits) < 3 or bits[2] == 'HTTPServer':
+           url = bits[0]
+           break
+# the dataset version is the last part of dataset_id, ex. cmip5.output1.NCAR.CCSM4....r1i1p1.v20120101|aims3.llnl.gov
+    version = doc.get('dataset_id', '').split('|')[0].split('.')[-1]
+    if not version: version = str(doc.get('version', ''))
+    checksum = (doc.get('checksum') or [''])[0]
+    checksum_type = (doc.get('checksum_type') or [''])[0]
+    return (doc.get('title', ''), url, checksum, checksum_type, str(doc.get('size', '')), version)
+
+
+def search_records(base, params, limit=10000):
+    ''' Return the records of all the files matching the query, requesting them from the search endpoint
+        in pages of limit files '''
+    fields = [('type', 'File'), ('format', 'application/solr+json'),
+              ('fields', 'title,url,checksum,checksum_type,size,version,dataset_id')]
+    records = []
+    offset = 0
+    while True:
+        url = base + 'search?' + urllib.urlencode(params + fields + [('limit', str(limit)), ('offset', str(offset))])
+        response = json.loads(cached_get(url))['response']
+        docs = response['docs']
+        records.extend([doc_record(doc) for doc in docs])
+        offset += len(docs)
+        if not docs or offset >= response['numFound']: break
+    return records
+
+
+def query_atoms(exp, modlist, varmips):
+    ''' Split a query in one query for each var_cmip-table and model, return a list of query parameters '''
+    atoms = []
+    for varmip in varmips:
+        var, mip = varmip.split('_')[0:2]
+        for mod in (modlist or [None]):
+            atoms.append(query_params(exp, [m for m in [mod] if m], [var], [mip]))
+    return atoms
+
+
+def write_records(recfile, records):
+    ''' Write the file records to a csv file, with a header line '''
+    f = open(recfile, 'wb')
+    writer = csv.writer(f)
+    writer.writerow(record_fields)
+    writer.writerows(records)
+    f.close()
+    return
+
+
+def read_records(recfile):
+    ''' Yield the file records from a csv file written by write_records '''
+    f = open(recfile, 'rb')
+    reader = csv.reader(f)
+    reader.next()
+    for row in reader:
+        yield row
+    f.close()
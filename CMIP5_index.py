@@ -0,0 +1,175 @@
+# Columnar index of the list of files on the replica tree
+#
+# The build step scans the weekly file list once and saves the unique ensembles as columns in a directory:
+#  - variable, mip, model, experiment, ensemble and version are dictionary encoded, each column is a numpy
+#    array of uint32 codes (<field>.npy) and the values are listed once in a string table (<field>.txt);
+#  - the ensemble paths are concatenated in paths.blob, paths.npy has the offset where each path starts;
+#  - meta.json has the file list used, its modification time and the number of ensembles.
+# Columns are opened as memory-mapped arrays, so opening the index doesn't read it and processes querying the same
+# index share the pages. A query converts the constraints to codes and selects the rows with one vectorised
+# comparison for each constrained column, only the selected rows are decoded.
+# The index needs numpy (module load python on raijin includes it).
+#
+# Build the index and query it, the query output is the same as search_CMIP5_replica.py:
+#
+#    python CMIP5_index.py build -o CMIP5_index
+#    python CMIP5_index.py query -d CMIP5_index -f mon -v tas -e historical -m CCSM4 -o output.csv
+#
+# The index is built in a new directory that replaces the old one only when complete,
+# processes that have the old index open keep using it.
+
+import os, json, mmap, shutil, argparse
+import numpy as np
+from CMIP5_parser import select_ensembles, read_paths, frequency_tables, parse_report
+
+# columns in the order of the records returned by select_ensembles
+columns = ['variable', 'mip', 'model', 'experiment', 'ensemble', 'version']
+infile = '/g/data1/ua6/unofficial-ESG-replica/tmp/tree/esg-tree-LATEST-paths.txt'
+
+
+def build_index(listfile, outdir):
+    ''' Scan the file list and save the unique ensembles as columns in outdir, return the number of ensembles '''
+    tables = [{} for c in columns]
+    codes = [[] for c in columns]
+    paths = []
+    found = set()
+    inf = open(listfile, 'r')
+    for rec in select_ensembles(read_paths(inf), []):
+        if rec in found: continue
+        found.add(rec)
+        for i in range(len(columns)):
+            codes[i].append(tables[i].setdefault(rec[i], len(tables[i])))
+        paths.append(rec[-1])
+    inf.close()
+# write to a temporary directory first, then replace the old index
+    tmpdir = outdir.rstrip('/') + '.tmp.%d' % os.getpid()
+    os.makedirs(tmpdir)
+    for i, name in enumerate(columns):
+        np.save(os.path.join(tmpdir, name + '.npy'), np.array(codes[i], dtype=np.uint32))
+        values = sorted(tables[i], key=tables[i].get)
+        f = open(os.path.join(tmpdir, name + '.txt'), 'w')
+        f.write('\n'.join(values))
+        f.close()
+    offsets = np.zeros(len(paths) + 1, dtype=np.uint64)
+    offsets[1:] = np.cumsum([len(p) for p in paths])
+    np.save(os.path.join(tmpdir, 'paths.npy'), offsets)
+    f = open(os.path.join(tmpdir, 'paths.blob'), 'wb')
+    f.write(''.join(paths))
+    f.close()
+    f = open(os.path.join(tmpdir, 'meta.json'), 'w')
+    json.dump({'file_list': listfile, 'mtime': os.path.getmtime(listfile), 'ensembles': len(paths)}, f)
+    f.close()
+    olddir = None
+    if os.path.exists(outdir):
+       olddir = outdir.rstrip('/') + '.old.%d' % os.getpid()
+       os.rename(outdir, olddir)
+    os.rename(tmpdir, outdir)
+    if olddir: shutil.rmtree(olddir)
+    return len(paths)
+
+
+class ColumnIndex(object):
+    ''' Memory-mapped columns of an index directory written by build_index '''
+
+    def __init__(self, indexdir):
+        self.meta = json.load(open(os.path.join(indexdir, 'meta.json')))
+        self.cols = {}
+        self.values = {}
+        self.codes = {}
+        for name in columns:
+            self.cols[name] = np.load(os.path.join(indexdir, name + '.npy'), mmap_mode='r')
+            f = open(os.path.join(indexdir, name + '.txt'), 'r')
+            self.values[name] = f.read().split('\n')
+            f.close()
+            self.codes[name] = dict((v, i) for i, v in enumerate(self.values[name]))
+        self.offsets = np.load(os.path.join(indexdir, 'paths.npy'), mmap_mode='r')
+        self.blob = ''
+        f = open(os.path.join(indexdir, 'paths.blob'), 'rb')
+        if os.fstat(f.fileno()).st_size > 0:
+           self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def stale(self):
+        ''' Return True if the file list changed after the index was built '''
+        try:
+            return os.path.getmtime(self.meta['file_list']) != self.meta['mtime']
+        except OSError:
+            return False
+
+    def select(self, cons):
+        ''' Return the positions of the rows matching the constraints {column: list of values} in file order '''
+        mask = None
+        for name, values in cons.items():
+            if not values: continue
+            codes = [self.codes[name][v] for v in set(values) if v in self.codes[name]]
+            if not codes: return np.zeros(0, dtype=np.int64)
+            col = self.cols[name]
+            if len(codes) == 1:
+               match = col == codes[0]
+            else:
+               match = np.in1d(col, codes)
+            if mask is None:
+               mask = match
+            else:
+               mask &= match
+        if mask is None:
+           return np.arange(len(self))
+        return np.flatnonzero(mask)
+
+    def record(self, i):
+        ''' Return row i as (variable, mip, model, experiment, ensemble, version, path) '''
+        rec = tuple(self.values[name][self.cols[name][i]] for name in columns)
+        return rec + (self.blob[int(self.offsets[i]):int(self.offsets[i+1])],)
+
+    def query(self, cons):
+        ''' Return the records matching the constraints {column: list of values} '''
+        return [self.record(i) for i in self.select(cons)]
+
+
+def parse_input():
+    ''' Parse input arguments '''
+    parser = argparse.ArgumentParser(description='''Builds a columnar index of the CMIP5 ensembles on the replica tree
+             and queries it with the same constraints as search_CMIP5_replica.py''')
+    sub = parser.add_subparsers(dest='command')
+    build = sub.add_parser('build', help='build the index from the file list')
+    build.add_argument('-i','--input', type=str, default=infile, help='file list, default is the weekly list of files on the tree', required=False)
+    build.add_argument('-o','--output', type=str, default='CMIP5_index', help='index directory, default CMIP5_index', required=False)
+    query = sub.add_parser('query', help='list the ensembles matching the constraints')
+    query.add_argument('-d','--index', type=str, default='CMIP5_index', help='index directory, default CMIP5_index', required=False)
+    query.add_argument('-e','--experiment', type=str, nargs="*", help='CMIP5 experiment', required=False)
+    query.add_argument('-m','--model', type=str, nargs="*", help='CMIP5 model', required=False)
+    query.add_argument('-v','--variable', type=str, nargs="*", help='CMIP5 variable', required=False)
+    query.add_argument('-t','--mip_table', type=str, nargs="*", help='CMIP5 MIP table', required=False)
+    query.add_argument('-f','--frequency', type=str, nargs="*", help='CMIP5 frequency', required=False)
+    query.add_argument('-o','--output', type=str, default='CMIP5_files_in_tree.csv', help='output file, default CMIP5_files_in_tree.csv', required=False)
+    return vars(parser.parse_args())
+
+
+def main():
+    ''' Build or query the index '''
+    args = parse_input()
+    if args["command"] == 'build':
+       n = build_index(args["input"], args["output"])
+       print parse_report()
+       print "Index of %d ensembles written to %s" % (n, args["output"])
+       return
+    index = ColumnIndex(args["index"])
+    if index.stale():
+       print "Warning: " + index.meta['file_list'] + " changed after the index was built, rebuild it to see the changes"
+    mips = list(args["mip_table"] or [])
+    for frq in args["frequency"] or []:
+        mips += frequency_tables.get(frq, [])
+    cons = {'variable': args["variable"], 'model': args["model"], 'experiment': args["experiment"], 'mip': mips}
+    outf = open(args["output"], 'w')
+    outf.write('variable,mip_table,model,experiment,ensemble,version,path\n')
+    for rec in index.query(cons):
+        outf.write(','.join(rec) + '\n')
+    outf.close()
+    print 'Output file: ' + args["output"]
+
+
+if __name__ == '__main__':
+    main()
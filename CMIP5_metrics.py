@@ -0,0 +1,98 @@
+# Run metrics for the CMIP5-utils scripts
+#
+# Each script times its main stages with "with stage(name):", reports progress of long loops with
+# progress(name, done, total) and at the end writes its counters (lines scanned, files hashed, ...) with summary().
+# Metrics are written as json lines to the file passed with --metrics, one object for each event:
+#  {"event": "stage", "stage": "hash", "wall": 12.3, "cpu": 10.1, "items": 2000, "rate": 162.6, ...}
+#  {"event": "progress", "stage": "classify", "done": 5000, "total": 20000, "rate": 410.2, "eta": 36.6, ...}
+#  {"event": "summary", "wall": 80.1, "cpu": 60.2, "counters": {"lines": 7000000, ...}, ...}
+# every object also has the script name, process id and time. The file is appended to, so several runs
+# (or the PBS jobs of a batch) can write to the same file.
+# The verbose level controls what is printed: 0 only warnings and errors, 1 (default) stage and progress
+# messages, 2 also a line for each file processed.
+
+import os, sys, time, json
+from contextlib import contextmanager
+
+metrics_file = None
+verbose = 1
+# minimum seconds between progress messages of the same stage
+progress_interval = 30
+# start time of the stages running and [start, last message] of each progress
+_stage_start = {}
+_last_progress = {}
+
+
+def cpu_time():
+    ''' Return the cpu time used by this process and its finished children '''
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+
+_start = (time.time(), cpu_time())
+
+
+def setup(mfile=None, level=1):
+    ''' Set the json lines file for the metrics, None to not write them, and the verbose level '''
+    global metrics_file, verbose
+    metrics_file = mfile
+    verbose = level
+    return
+
+
+def log(level, *args):
+    ''' Print the arguments if the verbose level is at least level '''
+    if verbose >= level:
+       print ' '.join([str(a) for a in args])
+
+
+def emit(event, **fields):
+    ''' Append an event to the metrics file '''
+    if not metrics_file: return
+    fields.update({'event': event, 'script': os.path.basename(sys.argv[0]), 'pid': os.getpid(),
+                   'time': round(time.time(), 3)})
+    f = open(metrics_file, 'a')
+    f.write(json.dumps(fields, sort_keys=True) + '\n')
+    f.close()
+
+
+@contextmanager
+def stage(name):
+    ''' Time the block as stage name. The block can set the number of items processed in the dictionary
+        returned, to report the throughput '''
+    st = {}
+    t0 = time.time()
+    c0 = cpu_time()
+    _stage_start[name] = t0
+    yield st
+    wall = time.time() - t0
+    fields = {'stage': name, 'wall': round(wall, 3), 'cpu': round(cpu_time() - c0, 3)}
+    if 'items' in st:
+       fields['items'] = st['items']
+       fields['rate'] = round(st['items'] / wall, 1) if wall > 0 else 0.0
+    emit('stage', **fields)
+    log(1, "Stage %s: %.2f s wall, %.2f s cpu" % (name, fields['wall'], fields['cpu']))
+
+
+def progress(name, done, total, unit='files'):
+    ''' Report that done of total items of stage name were processed, at most once every progress_interval seconds.
+        The rate is calculated from the start of the stage with the same name, or from the first call '''
+    now = time.time()
+    start, last = _last_progress.setdefault(name, [_stage_start.get(name, now), now])
+    if now - last < progress_interval and done < total: return
+    _last_progress[name][1] = now
+    rate = done / (now - start) if now > start else 0.0
+    eta = (total - done) / rate if rate > 0 else None
+    emit('progress', stage=name, done=done, total=total, unit=unit, rate=round(rate, 1),
+         eta=round(eta, 1) if eta is not None else None)
+    if eta is None:
+       log(1, "%s: %d/%d %s" % (name, done, total, unit))
+    else:
+       log(1, "%s: %d/%d %s (%.0f%%), %.1f %s/s, ETA %s" % (name, done, total, unit, 100.0 * done / max(total, 1),
+              rate, unit, time.strftime('%H:%M:%S', time.gmtime(eta))))
+
+
+def summary(**counters):
+    ''' Write the total wall and cpu time of the run and the counters passed as arguments '''
+    wall = time.time() - _start[0]
+    emit('summary', wall=round(wall, 3), cpu=round(cpu_time() - _start[1], 3), counters=counters)
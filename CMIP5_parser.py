@@ -0,0 +1,277 @@
+# Shared parsing functions for the CMIP5-utils scripts
+# search_CMIP5_replica.py, CMIP5_replica_db.py, find_matching_variables.py,
+# fetch_step1.py and fetch_step2.py all import the helpers they need from here,
+# instead of keeping their own copy of file_details, match_constraints and find_string.
+#
+# Path lines follow the DRS structure of the replica tree, for example
+#  .../output1/<institute>/<model>/<experiment>/<frequency>/<realm>/<cmip_table>/<ensemble>/<version>/<variable>/<file>
+# and filenames are
+#  <variable>_<cmip_table>_<model>_<experiment>_<ensemble>[_<period>].nc
+#
+# Parsing is the hot loop of all the tools, so the version pattern is compiled once,
+# constraints are converted once to frozensets and the version is looked up first in the
+# directories where the DRS puts it, only falling back to scanning all the path.
+# parse_stats keeps a count of the lines parsed and of the time spent doing it,
+# parse_report() returns it as a string with the average cost per line.
+#
+# scan_file can split the input file in byte ranges aligned on newlines and scan them on multiple processes,
+# each process returns the unique matching records of its shard in the order they were found and the shards
+# are merged in order, so the output is the same as scanning the file serially.
+#
+# Many named constraint sets can be answered with one scan (read_batch): the file is scanned with the union of
+# the constraints and each matching record is routed to the sets it satisfies with an inverted index of the
+# constraint values (compile_router/route), which gives the mask of the matching sets with one lookup for each field.
+
+import re, time, ConfigParser
+import os.path as opath
+from multiprocessing import Pool
+from CMIP5_metrics import progress
+
+# define a valid pattern for version
+version_re = re.compile('[a-z]*201[0-9][0-1][0-9][0-3][0-9]')
+
+# position in the file details list of each field
+VAR, MIP, MODEL, EXP, ENS = range(5)
+
+# cmip5 mip tables corresponding to each frequency
+frequency_tables = {'day': ['day', 'cfDay', 'dayExtras'],
+                    'mon': ['Omon', 'OmonExtras', 'Amon', 'AmonExtras', 'Lmon',
+                            'LmonExtras', 'OImon', 'LImon', 'cfMon', 'aero', 'cfOff'],
+                    '3hr': ['3hr', '3hrLev', 'cf3hr', 'cfSites'],
+                    '6hr': ['6hr', '6hrPlev', '6hrLev'],
+                    'monClim': ['Oclim', 'Lclim', 'Aclim', 'LIclim'],
+                    'yr': ['Oyr', 'OyrExtras'],
+                    'fx': ['fx'],
+                    'subhr': ['cfSites']}
+
+# counters updated by select_ensembles
+parse_stats = {'lines': 0, 'matched': 0, 'seconds': 0.0}
+
+
+def VarCmipTable(v):
+    ''' Check variable is passed as var_cmip-table, used as argparse type '''
+    if "_" not in v:
+      raise TypeError("String '%s' does not match required format: var_cmip-table, ie tas_Amon"%(v,))
+    else:
+      return v
+
+
+def split_varmip(varmip):
+    ''' Split a var_cmip-table string in variable and cmip table '''
+    return varmip.split("_")[0:2]
+
+
+def file_details(fname):
+    ''' Split the filename in variable, MIP code, model, experiment, ensemble (period is excluded) '''
+    namebits = fname.split('_', 5)
+    if len(namebits) >= 5:
+      details = namebits[0:5]
+    else:
+      details = []
+    return details
+
+
+def csv_details(line):
+    ''' Split a line of the search_CMIP5_replica.py output in variable, MIP code, model, experiment, ensemble '''
+    return line.split(',', 5)[0:5]
+
+
+def compile_constraints(var0, mod0, exp0, mip0):
+    ''' Convert the constraints lists to a list of (details position, frozenset of values),
+        constraints that are empty select all values and are left out '''
+    cons = [(VAR, var0), (MODEL, mod0), (EXP, exp0), (MIP, mip0)]
+    return [(pos, frozenset(values)) for pos, values in cons if values]
+
+
+def match_constraints(details, cons):
+    ''' Return True if the file details satisfy all the compiled constraints '''
+    for pos, values in cons:
+        if details[pos] not in values:
+           return False
+    return True
+
+
+def find_version(bits, default='not_specified'):
+    ''' Returns the version directory from the list of directories of a file path.
+        The DRS puts the version just before the variable directory, or as last directory,
+        the other directories are searched only if neither of those is a version '''
+    for el in bits[-2:-1] + bits[-1:]:
+        if version_re.search(el):
+           return el
+    for el in bits:
+        if version_re.search(el):
+           return el
+    return default
+
+
+def version_date(version):
+    ''' Return the date of a version directory as yyyymmdd, or None if the version isn't a date '''
+    m = version_re.search(version or '')
+    if m is None: return None
+    return m.group(0)[-8:]
+
+
+def read_batch(batchfile):
+    ''' Read the named constraint sets of a batch file, in ini format with a section for each set:
+          [name]
+          variable = tas ua
+          experiment = historical rcp45
+          model, mip_table and frequency are the other options, output is the csv file (default name.csv).
+        Return a list of (name, output, compiled constraints) in the order of the file '''
+    parser = ConfigParser.RawConfigParser()
+    if not parser.read(batchfile):
+       raise IOError("Can not read batch file " + batchfile)
+    queries = []
+    for name in parser.sections():
+        opts = dict((k, v.replace(',', ' ').split()) for k, v in parser.items(name))
+        mip0 = opts.get('mip_table', [])
+        for frq in opts.get('frequency', []):
+            mip0 = mip0 + frequency_tables.get(frq, [])
+        outfile = name + '.csv'
+        if opts.get('output'): outfile = opts['output'][0]
+        cons = compile_constraints(opts.get('variable', []), opts.get('model', []),
+                                   opts.get('experiment', []), mip0)
+        queries.append((name, outfile, cons))
+    return queries
+
+
+def union_constraints(queries):
+    ''' Return the compiled constraints selecting the records that match at least one of the queries:
+        a field is constrained only if all the queries constrain it, to the union of their values '''
+    cons = []
+    for pos in [VAR, MODEL, EXP, MIP]:
+        values = [dict(q).get(pos) for q in queries]
+        if values and None not in values:
+           cons.append((pos, frozenset().union(*values)))
+    return cons
+
+
+def compile_router(queries):
+    ''' Build an inverted index of the values of the queries' constraints, each query is a bit of a mask.
+        Return a list of (position, {value: mask of the queries selecting it}, mask of the queries not constraining it) '''
+    router = []
+    for pos in [VAR, MODEL, EXP, MIP]:
+        index = {}
+        wild = 0
+        for i, cons in enumerate(queries):
+            values = dict(cons).get(pos)
+            if values is None:
+               wild |= 1 << i
+               continue
+            for v in values:
+                index[v] = index.get(v, 0) | 1 << i
+        router.append((pos, index, wild))
+    return router
+
+
+def route(details, router):
+    ''' Return the mask of the queries matching the file details '''
+    mask = -1
+    for pos, index, wild in router:
+        mask &= index.get(details[pos], 0) | wild
+        if not mask: break
+    return mask
+
+
+def read_paths(inf):
+    ''' Yield the file paths listed in the input file one at a time, without reading the whole file '''
+    for line in inf:
+        yield line.rstrip('\n')
+
+
+def select_ensembles(paths, cons):
+    ''' Yield (variable, MIP code, model, experiment, ensemble, version, path) for each file matching the constraints '''
+    lines = 0
+    matched = 0
+    t0 = time.time()
+    for filepath in paths:
+        lines += 1
+        bits = filepath.split('/')
+        details = file_details(bits[-1])
+# make sure details list isn't empty and file details satisfies the constraints
+        if details and match_constraints(details, cons):
+           dirs = bits[:-1]
+           matched += 1
+           record = tuple(details) + (find_version(dirs), '/'.join(dirs))
+           parse_stats['seconds'] += time.time() - t0
+           yield record
+           t0 = time.time()
+    parse_stats['seconds'] += time.time() - t0
+    parse_stats['lines'] += lines
+    parse_stats['matched'] += matched
+
+
+def shard_ranges(infile, nshards):
+    ''' Split the input file in nshards byte ranges (start, end), each range starts at the beginning of a line '''
+    size = opath.getsize(infile)
+    bounds = [0]
+    f = open(infile, 'rb')
+    for i in range(1, nshards):
+        raw = size * i // nshards
+# move to the first line starting at or after raw
+        if raw > 0:
+           f.seek(raw - 1)
+           f.readline()
+        bounds.append(max(f.tell(), bounds[-1]))
+    f.close()
+    bounds.append(size)
+    return [(bounds[i], bounds[i+1]) for i in range(nshards) if bounds[i] < bounds[i+1]]
+
+
+def read_shard(infile, start, end):
+    ''' Yield the file paths in the byte range start-end of the input file, without the newline '''
+    f = open(infile, 'rb')
+    f.seek(start)
+    pos = start
+    while pos < end:
+        line = f.readline()
+        if not line: break
+        pos += len(line)
+        yield line.rstrip('\n')
+    f.close()
+
+
+def _scan_shard(args):
+    ''' Scan a shard of the input file, return the unique matching records in the order found and the shard parse_stats '''
+    infile, start, end, cons = args
+    for k in parse_stats: parse_stats[k] = 0
+    records = []
+    found = set()
+    for rec in select_ensembles(read_shard(infile, start, end), cons):
+        if rec not in found:
+           found.add(rec)
+           records.append(rec)
+    return records, dict(parse_stats)
+
+
+def scan_file(infile, cons, nproc=1):
+    ''' Yield the records matching the constraints in the input file, using nproc processes if nproc > 1.
+        With multiple processes each record is yielded only once '''
+    if nproc <= 1:
+       inf = open(infile, 'r')
+       for rec in select_ensembles(read_paths(inf), cons):
+           yield rec
+       inf.close()
+       return
+# use more shards than processes, so processes that finish early can take another shard
+    shards = [(infile, start, end, cons) for start, end in shard_ranges(infile, nproc * 4)]
+    pool = Pool(nproc)
+    found = set()
+    for i, (records, stats) in enumerate(pool.imap(_scan_shard, shards)):
+        for k in stats: parse_stats[k] += stats[k]
+        progress("scan", i + 1, len(shards), "shards")
+        for rec in records:
+            if rec not in found:
+               found.add(rec)
+               yield rec
+    pool.close()
+    pool.join()
+
+
+def parse_report():
+    ''' Return a summary of parse_stats, including the average parse cost per line '''
+    lines = parse_stats['lines']
+    cost = 0.0
+    if lines > 0: cost = parse_stats['seconds'] / lines * 1e6
+    return "Parsed %d lines, %d matching, in %.2f s (%.2f us/line)" % (lines,
+           parse_stats['matched'], parse_stats['seconds'], cost)
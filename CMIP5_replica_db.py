@@ -6,6 +6,13 @@
 # The file list used as input is updated every Monday or after we downloaded more cmip5 data.
 # It creates a sqlite database called CMIP5_database.db, that contains a "cmip5" table 
 # with the following fields id (this is actually the ensemble path on raijin and acts as unique index), variable, mip, model, experiment, ensemble, version, for each matching ensemble.
+# Rows are loaded in bulk in a single transaction, the variable, mip, model and experiment fields are indexed after loading.
+# If the database already exists, it is updated comparing the new file list to the rows matching the same constraints:
+# new ensembles are added, ensembles with a different version updated and ensembles no longer in the tree are kept
+# but their "status" field is changed from current to removed. The "updated" field has the date of the last change.
+# As the id includes the version directory, a new version is found comparing variable, mip, model, experiment and
+# ensemble: if the old version is no longer in the tree its row is updated with the new id and version, if both
+# versions are in the tree the new one is added as a new row.
 # Example of how to run on raijin.nci.org.au
 #
 #    module load python
@@ -16,6 +23,11 @@
 #  - to pass multiple arguments, declare the option once followed by all desired values (as above);
 #  - you can pass a different name for the output file, using -o/--output option (output.db in the example); 
 #  - all arguments are optional; 
+#  - -j/--nproc N scans the file list with N processes, each one reading a different part of the file;
+#  - -i/--input FILE reads a different file list, with the same format;
+#  - --metrics FILE appends the time of each stage and the number of lines scanned and ensembles changed as json lines,
+#    --verbose 0 prints only warnings;
+#  - -s/--server URL gets the matching ensembles from a CMIP5_daemon.py service instead of scanning the file list;
 #  - failing to set any constraint will result in the entire dataset being 
 #    selected.  
 #
@@ -31,6 +43,11 @@ import os, datetime, glob, re
 import sys, getopt   # these are needed to accept external arguments
 import sqlite3, argparse
 import itertools as it
+from CMIP5_parser import scan_file, compile_constraints, parse_report, frequency_tables, parse_stats
+from CMIP5_parser import VAR, MIP, MODEL, EXP
+from CMIP5_daemon import query_server
+import CMIP5_metrics
+from CMIP5_metrics import stage, log
 
 ## helper functions
 
@@ -53,81 +70,62 @@ def parse_input():
     parser.add_argument('-v','--variable', type=str, nargs="*", help='CMIP5 variable', required=False)
     parser.add_argument('-t','--mip_table', type=str, nargs="*", help='CMIP5 MIP table', required=False)
     parser.add_argument('-f','--frequency', type=str, nargs="*", help='CMIP5 frequency', required=False)
+    parser.add_argument('-j','--nproc', type=int, default=1, help='number of processes used to scan the file list, default 1', required=False)
+    parser.add_argument('-s','--server', type=str, default=None, help='''url of a CMIP5_daemon.py service to query
+                        instead of scanning the file list''', required=False)
+    parser.add_argument('-i','--input', type=str, default=None, help='''file list to read,
+                        default is the weekly list of files on the tree''', required=False)
+    parser.add_argument('--metrics', type=str, default=None, help='append the run metrics as json lines to this file', required=False)
+    parser.add_argument('--verbose', type=int, default=1, help='0 prints only warnings, default 1 also prints progress', required=False)
     parser.add_argument('-o','--output', type=str, nargs=1, help='database output file name', required=False)
     return vars(parser.parse_args())
 
 
-def file_details(fname):
-    ''' Split the filename in variable, MIP code, model, experiment, ensemble (period is excluded) ''' 
-    namebits = fname.split('_')
-    if len(namebits) >= 5:
-      details = namebits[0:5] 
-    else:
-      details = []
-    return details
-
-
-def match_constraints(details,cons):
-    ''' If the variable and experiment match the constraints add file to list '''
-    con_num = len(cons)
-    i = 0
-    details_set = set(details)
-    add_file = True
-    while i <= con_num -1:
-       if len(cons[i]) > 0:
-         if list(details_set.intersection(cons[i])) == []:
-            add_file = False
-            break 
-       i +=1
-    return add_file
-    
+def add_rows(rows, batch=10000):
+    ''' Insert the rows in the database in batches, return number of new rows.
+        It doesn't commit, so it can be called inside the same transaction as other changes '''
+    global conn
+# executemany takes the rows in chunks of batch length so the generator is never fully loaded in memory
+# rows already in the database are ignored
+    rows = iter(rows)
+    nrows = conn.total_changes
+    while True:
+        chunk = list(it.islice(rows, batch))
+        if not chunk: break
+        conn.executemany("INSERT OR IGNORE INTO cmip5(id, variable, mip, model, experiment, ensemble, version, status, updated) VALUES(?,?,?,?,?,?,?,'current',?)",
+                         [row + (today,) for row in chunk])
+    return conn.total_changes - nrows
+
+
+def unique_rows(records):
+    ''' Yield database rows, with the ensemble path first, once for each ensemble '''
+# db_set is a set of unique rows already yielded, 1 row for each ensemble
+    db_set = set()
+    for rec in records:
+        row = rec[-1:] + rec[:-1]
+        if row not in db_set:
+           db_set.add(row)
+           yield row
+
 
-def find_string(bits,string):
-    ''' Returns matching string if found in directory structure '''
-    dummy = filter(lambda el: re.findall( string, el), bits)
-    if len(dummy) == 0:
-        return 'not_specified'
-    else:
-        return dummy[0]
-
-
-def add_row(tup_details):
-    global conn,c
-    ''' If found file check if it's already in database, otherwise add to it '''
-# Insert a row with file details and commit changes
-    details=list(tup_details)
-    fpath,var,mip,mod,exp,ens,ver = details
-    c.execute("INSERT INTO cmip5(id, variable, mip, model, experiment, ensemble, version) VALUES(?,?,?,?,?,?,?)",
-              (fpath,var,mip,mod,exp,ens,ver))
-    conn.commit()
+def create_indexes():
+    ''' Create the indexes on the fields used to query the database, done after loading the rows '''
+    global conn
+    with conn:
+        for field in ['variable', 'mip', 'model', 'experiment']:
+            conn.execute("CREATE INDEX IF NOT EXISTS cmip5_" + field + " ON cmip5(" + field + ")")
     return
 
 
 def assign_frequency(frq):
     ''' Append the cmip5 mip tables corresponding to the input frequency to the list mip0 ''' 
     global mip0
-    if frq == 'day':
-       mip0 = mip0 + ['day', 'cfDay', 'dayExtras']
-    elif frq == 'mon':
-       mip0 = mip0 + ['Omon', 'OmonExtras', 'Amon', 'AmonExtras', 'Lmon', 
-                 'LmonExtras', 'OImon', 'LImon', 'cfMon', 'aero', 'cfOff']
-    elif frq == '3hr':
-       mip0 = mip0 + ['3hr', '3hrLev', 'cf3hr', 'cfSites']
-    elif frq == '6hr':
-       mip0 = mip0 + ['6hr', '6hrPlev', '6hrLev'] 
-    elif frq == 'monClim':
-       mip0 = mip0 + ['Oclim', 'Lclim', 'Aclim', 'LIclim'] 
-    elif frq == 'yr':
-       mip0 = mip0 + ['Oyr', 'OyrExtras'] 
-    elif frq == 'fx':
-       mip0 = mip0 + ['fx'] 
-    elif frq == 'subhr':
-       mip0 = mip0 + ['cfSites']
+    mip0 = mip0 + frequency_tables.get(frq, [])
 
 
 def assign_constraint():
     ''' Assign default values and input to constraints '''
-    global var0, exp0, mod0, mip0, dbfile 
+    global var0, exp0, mod0, mip0, dbfile, nproc, server, infile
 # assign constraints from arguments list
     args = parse_input()
     var0=args["variable"]
@@ -138,8 +136,12 @@ def assign_constraint():
     if not exp0: exp0=[]
     mip0=args["mip_table"]
     if not mip0: mip0=[]
-    dbfile=args["output"][0]+ ".db"
-    if not dbfile: dbfile = 'CMIP5_database.db' 
+    dbfile = 'CMIP5_database.db' 
+    if args["output"]: dbfile=args["output"][0]+ ".db"
+    nproc=args["nproc"]
+    server=args["server"]
+    if args["input"]: infile=args["input"]
+    CMIP5_metrics.setup(args["metrics"], args["verbose"])
     frq0=args["frequency"]
     if frq0: 
        for frq in frq0:
@@ -148,39 +150,115 @@ def assign_constraint():
 
 
 def select_match(constraints):
-    ''' pre-select rows from database that match constraints to avoid adding them again to database '''
-# still working on this!
-    fields=""
-    values=[]
-    print constraints
-    print constraints
-    #constraints = filter(bool, constraints)
-    #comb_constraints = set(it.product(*constraints))
-    #print comb_constraints
-# build key, values comb using constraints!
-    for key in comb:
-        fields+= key+"==? AND "
-        values.append(comb[key])
-    print fields
-    print tuple(values)
-    cursor = conn.execute("SELECT * FROM cmip5 where " + fields[:-4], tuple(values))  
-    rows=cursor.fetchall()
-    print rows
+    ''' Select the rows already in the database that match the constraints, 
+        return a dictionary {id: (row, status)} '''
+    global conn
+    fields = {VAR: 'variable', MIP: 'mip', MODEL: 'model', EXP: 'experiment'}
+    where = []
+    values = []
+# build a "field IN (?,?,..)" condition for each constraint, these are resolved using the indexes
+    for pos, cons in constraints:
+        where.append(fields[pos] + " IN (" + ",".join(["?"]*len(cons)) + ")")
+        values.extend(cons)
+    sql = "SELECT id, variable, mip, model, experiment, ensemble, version, status FROM cmip5"
+    if where: sql += " WHERE " + " AND ".join(where)
+    rows = {}
+    for row in conn.execute(sql, values):
+        rows[row[0]] = (tuple(row[0:-1]), row[-1])
     return rows
 
 
+def ensemble_key(row):
+    ''' Return variable, mip, model, experiment and ensemble of a row, the same for all the versions of an ensemble '''
+    return row[1:6]
+
+
+def new_rows(rows, dbrows, changed, versions):
+    ''' Compare rows from the file list to the ones in the database: yield the new rows,
+        add to changed the ones that were marked as removed and to versions the rows with a new id
+        for an ensemble already in the database, which can be a new version of one of its rows.
+        The rows found are deleted from dbrows, so what is left at the end was removed from the tree '''
+    ensembles = set(ensemble_key(v[0]) for v in dbrows.values())
+    for row in rows:
+        old = dbrows.pop(row[0], None)
+        if old is not None:
+           if old != (row, 'current'): changed.append(row[1:] + ('current', today, row[0]))
+        elif ensemble_key(row) in ensembles:
+           versions.append(row)
+        else:
+           yield row
+
+
+def replace_versions(versions, dbrows):
+    ''' Pair each row in versions with a row of the same ensemble left in dbrows, preferring a current one, and return
+        the parameters to update the old row with the new id and version. The rows paired are deleted from dbrows,
+        the rows that couldn't be paired are left in versions '''
+    left = {}
+    for k in sorted(dbrows, key=lambda k: dbrows[k][1] == 'current'):
+        left.setdefault(ensemble_key(dbrows[k][0]), []).append(k)
+    replaced = []
+    unpaired = []
+    for row in versions:
+        ids = left.get(ensemble_key(row))
+        if ids:
+           oldid = ids.pop()
+           del dbrows[oldid]
+           replaced.append(row + ('current', today, oldid))
+        else:
+           unpaired.append(row)
+    versions[:] = unpaired
+    return replaced
+
+
+def update_db(rows, constraints):
+    ''' Apply to the database only the differences between the rows from the file list and the rows
+        matching the same constraints already in the database, all inside one transaction.
+        Return the number of rows added, updated and removed '''
+    global conn
+    dbrows = select_match(constraints)
+    changed = []
+    versions = []
+    with conn:
+        nnew = add_rows(new_rows(rows, dbrows, changed, versions))
+        conn.executemany("UPDATE cmip5 SET variable=?, mip=?, model=?, experiment=?, ensemble=?, version=?, status=?, updated=? WHERE id=?",
+                         changed)
+# a new version replaces the row of an old version no longer in the tree, otherwise it is added
+        replaced = replace_versions(versions, dbrows)
+        conn.executemany("UPDATE cmip5 SET id=?, variable=?, mip=?, model=?, experiment=?, ensemble=?, version=?, status=?, updated=? WHERE id=?",
+                         replaced)
+        nnew += add_rows(versions)
+        changed += replaced
+# rows left in dbrows were not in the file list anymore, they are marked as removed
+        removed = [(today, k) for k, v in dbrows.items() if v[1] == 'current']
+        conn.executemany("UPDATE cmip5 SET status='removed', updated=? WHERE id=?", removed)
+    return nnew, len(changed), len(removed)
+
+
 def open_db(dbfile):
+    ''' Open the database, setting pragmas for bulk loading, and create the cmip5 table if it doesn't exist '''
     conn = sqlite3.connect(dbfile)
-    c = conn.cursor()
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-200000")
+    conn.execute("PRAGMA temp_store=MEMORY")
     # Create table cmip5 if doesn't exists
-    c.execute('''CREATE TABLE IF NOT EXISTS cmip5
-             (id text, variable text, mip text, model text, experiment text, ensemble text, version text)''')
-    # Save (commit) the changes
-    conn.commit()
-    c.close()
-    conn.close()
-    print "Opened database successfully";
-    return sqlite3.connect(dbfile)
+    conn.execute('''CREATE TABLE IF NOT EXISTS cmip5
+             (id text PRIMARY KEY, variable text, mip text, model text, experiment text, ensemble text, version text,
+              status text DEFAULT 'current', updated text)''')
+    # add status and updated fields to databases created by older versions
+    columns = [x[1] for x in conn.execute("PRAGMA table_info(cmip5)")]
+    if 'status' not in columns:
+       conn.execute("ALTER TABLE cmip5 ADD COLUMN status text DEFAULT 'current'")
+    if 'updated' not in columns:
+       conn.execute("ALTER TABLE cmip5 ADD COLUMN updated text")
+    # databases created by older versions have no key on id and can have duplicated rows:
+    # remove duplicates and add a unique index
+    if not [x for x in conn.execute("PRAGMA index_list(cmip5)") if x[2]]:
+       with conn:
+           conn.execute("DELETE FROM cmip5 WHERE rowid NOT IN (SELECT min(rowid) FROM cmip5 GROUP BY id)")
+           conn.execute("CREATE UNIQUE INDEX cmip5_id ON cmip5(id)")
+    log(1, "Opened database successfully")
+    return conn
 
 
 # Main program starts here
@@ -190,54 +268,37 @@ infile = '/g/data/ua6/unofficial-ESG-replica/tmp/tree/esg-tree-LATEST-paths.txt'
 # assign default values to constraints
 assign_constraint()
  
-# join constraints in a list
-constraints = [var0, mod0, exp0, mip0]
-print 'Output database: ' + dbfile 
+# join constraints in a list of frozensets
+constraints = compile_constraints(var0, mod0, exp0, mip0)
+log(1, 'Output database: ' + dbfile)
     
 ### needs to include something to take care of all decadals
-# open input file and database
-inf = open(infile, 'r')
+# open database
 conn = open_db(dbfile)
-c = conn.cursor()
-
-# read all the file paths line by line
-lines = inf.readlines()
-
-# define a valid pattern for version
-version = '[a-z]*201[0-9][0-1][0-9][0-3][0-9]'
-# db_set is a set of unique rows to add to the database, 1 row for each ensemble
-db_set = set()
-# loops through all the files
-for filepath in lines[:]:
-    filepath.replace('\n','')
-    bits = filepath.split('/')
-    fname = (bits[-1])[:-1]
-# call file_details to retrieve experiment, variable, model etc. from filename 
-    details = file_details(fname)
-# make sure details list isn't empty 
-    if len(details) > 0:
-# if file details satisfies the constraint file added to output 
-      if match_constraints(details,constraints):
-         vers = find_string(bits[:-1], version)
-         newpath = '/'.join(bits[:-1])
-         slist = [newpath] + details + [vers]
-         db_set.add(tuple(slist))
-
-# load from database rows that match constraints
-# still working on this!!! is commented for the moment
-#rows_set = select_match(constraints) 
-# the difference between two sets gives rows not yet in database
-#notindb_set = rows_set.difference(db_set)
-
-# write to output database 
-for row in db_set:
-#for row in notindb_set:
-    add_row(row)
-
-# close input and output file
-inf.close
-c.close()
-conn.close()
 
-    
+# only matching ensembles are kept in memory, the file list is read lazily
+# if nproc > 1 the file list is split in shards scanned by nproc processes
+# rows are compared to the ones matching the constraints already in the database and only differences are applied
+# if a server is given the ensembles are requested from it and the file list is scanned only if it can't be reached
+today = datetime.date.today().isoformat()
+records = None
+if server:
+   try:
+       records = query_server(server, var0, mod0, exp0, mip0)
+       log(1, 'Query answered by ' + server)
+   except IOError as e:
+       print 'Warning: could not query ' + server + ' (' + str(e) + '), scanning the file list'
+scanned = records is None
+if scanned:
+   records = scan_file(infile, constraints, nproc)
+with stage('update_db') as st:
+    nnew, nchanged, nremoved = update_db(unique_rows(records), constraints)
+    st['items'] = parse_stats['lines']
+if scanned: log(1, parse_report())
+log(1, "Added %d new ensembles, updated %d, marked %d as removed" % (nnew, nchanged, nremoved))
+with stage('create_indexes'):
+    create_indexes()
+CMIP5_metrics.summary(lines=parse_stats['lines'], matched=parse_stats['matched'], added=nnew, updated=nchanged, removed=nremoved)
 
+# close database
+conn.close()
@@ -0,0 +1,119 @@
+# Index of the files on the replica tree, used by fetch_step2.py to check if a published file exists on raijin
+#
+# Instead of calling os.path.exists for every published file, and for aims3.llnl.gov files up to three more times
+# for the old pcmdi3/7/9.llnl.gov server names, the index is built once at the start and each check is a
+# dictionary lookup. The index is built either:
+#  - from the weekly list of the files on the tree (esg-tree-LATEST-paths.txt), reading it once and keeping
+#    only the files whose name is one of the published files. Files added after the list was updated are missed;
+#  - by listing only the directories where the published files should be, one os.listdir for each directory
+#    instead of one stat for each file.
+# Paths are stored relative to the tree root, which is the same as the file url without "http://". Paths of the
+# listing that aren't under the tree root can't be checked: a warning is printed, and if they are more than the
+# paths under the root the listing is for another tree and ValueError is raised.
+# Files stored under the old server names are indexed under the new name too, as alias, so checking the url
+# with the new name finds them. A file stored under the new name takes precedence over the aliases.
+# If the index isn't built tree_exist falls back to checking the files on disk.
+
+import os
+import os.path as opath
+
+tree_root = "/g/data1/ua6/unofficial-ESG-replica/tmp/tree/"
+listing = tree_root + "esg-tree-LATEST-paths.txt"
+# servers that changed name, as {new name: [old names in order of precedence]}
+server_alias = {"aims3.llnl.gov": ["pcmdi3.llnl.gov", "pcmdi7.llnl.gov", "pcmdi9.llnl.gov"]}
+old_servers = dict((old, (new, i)) for new in server_alias for i, old in enumerate(server_alias[new]))
+# index as {url: path relative to tree root}, None if not built
+index = None
+
+
+def set_tree(root):
+    ''' Set the tree root directory '''
+    global tree_root
+    root = opath.abspath(root)
+    if not root.endswith('/'): root += '/'
+    tree_root = root
+    return
+
+
+def alias_urls(furl):
+    ''' Return the list of paths a file could have on the tree if its server changed name, in order of precedence '''
+    server, rest = (furl.split('/', 1) + [''])[0:2]
+    return [old + '/' + rest for old in server_alias.get(server, [])]
+
+
+def _add(idx, precedence, relpath):
+    ''' Add a path to the index, and if the server is an old name also as an alias for the new name '''
+    idx[relpath] = relpath
+    precedence[relpath] = -1
+    server, rest = (relpath.split('/', 1) + [''])[0:2]
+    if server in old_servers:
+       new, rank = old_servers[server]
+       key = new + '/' + rest
+       if precedence.get(key, len(old_servers)) > rank:
+          idx[key] = relpath
+          precedence[key] = rank
+    return
+
+
+def build_from_listing(urls, listfile=None):
+    ''' Build the index for the urls reading the list of files on the tree, return the number of files indexed '''
+    global index
+    if listfile is None: listfile = listing
+    names = frozenset(furl.rsplit('/', 1)[-1] for furl in urls)
+    idx = {}
+    precedence = {}
+# the listing has full paths, store them relative to the tree root, which can be written through a symbolic link
+    roots = sorted(set([tree_root, opath.realpath(tree_root) + '/']), key=len, reverse=True)
+    outside = 0
+    for line in open(listfile, 'r'):
+        line = line.rstrip('\n')
+        if line.rsplit('/', 1)[-1] not in names: continue
+        for root in roots:
+            if line.startswith(root):
+               _add(idx, precedence, line[len(root):])
+               break
+        else:
+            outside += 1
+    if outside > len(idx):
+       raise ValueError("%d of the files in %s are not under the tree root %s, only %d are"
+                        % (outside, listfile, tree_root, len(idx)))
+    if outside: print "Warning: %d files in %s are not under the tree root %s" % (outside, listfile, tree_root)
+    index = idx
+    return len(idx)
+
+
+def build_from_scan(urls):
+    ''' Build the index for the urls listing each directory where the urls, or their aliases, should be on the tree.
+        Return the number of files indexed '''
+    global index
+    names = frozenset(furl.rsplit('/', 1)[-1] for furl in urls)
+    dirs = set()
+    for furl in urls:
+        for path in [furl] + alias_urls(furl):
+            dirs.add(path.rsplit('/', 1)[0])
+    idx = {}
+    precedence = {}
+    for d in dirs:
+        try:
+            files = os.listdir(tree_root + d)
+        except OSError:
+            continue
+        for f in files:
+            if f in names: _add(idx, precedence, d + '/' + f)
+    index = idx
+    return len(idx)
+
+
+def tree_exist(furl):
+    ''' Return [True, path] if file exists in tree, including under an old server name, or [False, path].
+        If the file isn't found path is the last one checked, as the old server names are checked after the new one '''
+    paths = [furl] + alias_urls(furl)
+    if index is not None:
+       relpath = index.get(furl)
+       if relpath is None:
+          return [False, tree_root + paths[-1]]
+       return [True, tree_root + relpath]
+    for path in paths:
+        if opath.exists(tree_root + path):
+           return [True, tree_root + path]
+    return [False, tree_root + paths[-1]]
@@ -0,0 +1,309 @@
+# Benchmark of the CMIP5-utils scripts on synthetic data
+#
+# Generates in a work directory inputs shaped like the real ones, without needing /g/data or ESGF:
+#  - a list of files on the tree (paths.txt) with --lines paths following the DRS;
+#  - wget_historical.out and wget_rcp45.out scripts listing published files for a few variables and models;
+#  - a fake tree with --tree-files of the published files, each --file-size bytes. Most have the published
+#    checksum, some are modified and some are stored under the old pcmdi9.llnl.gov server name.
+# The inputs are generated again only if the parameters change.
+# Then it times each stage, as wall and cpu time (including child processes) and items processed per second:
+#  scan        read the file list line by line
+#  parse       split all the paths in file details and version
+#  match       parse and select the paths matching a set of constraints
+#  search      run search_CMIP5_replica.py on the file list
+#  db_load     run CMIP5_replica_db.py loading the whole file list in a new database
+#  tree_lookup index the tree from the file list and check if each published file exists
+#  hash        calculate the checksum of all the files on the fake tree
+#  step2       run fetch_step2.py on the wget scripts and the fake tree, writing the summary table too,
+#              the time of each of its stages (tree index, classify, hash, write outputs, table) is added from its metrics
+# Results are written as json (default bench_CMIP5.json), --compare shows the change from a previous result.
+#
+#    python bench_CMIP5.py --lines 1000000 --tree-files 2000 --file-size 4194304 -o after.json --compare before.json
+
+import os, sys, json, time, random, hashlib, platform, subprocess, shutil, datetime, argparse
+from CMIP5_parser import read_paths, select_ensembles, compile_constraints
+import CMIP5_tree, CMIP5_checksum
+
+# directory of the scripts that are run as separate processes
+script_dir = os.path.dirname(os.path.abspath(__file__))
+stage_names = ['scan', 'parse', 'match', 'search', 'db_load', 'tree_lookup', 'hash', 'step2']
+
+# facets of the synthetic files: (variable, cmip table, frequency, realm), (institute, model)
+variables = [('tas', 'Amon', 'mon', 'atmos'), ('ua', 'Amon', 'mon', 'atmos'), ('pr', 'Amon', 'mon', 'atmos'),
+             ('tos', 'Omon', 'mon', 'ocean'), ('so', 'Omon', 'mon', 'ocean'), ('pr', 'day', 'day', 'atmos'),
+             ('tasmax', 'day', 'day', 'atmos'), ('ta', '6hrPlev', '6hr', 'atmos'), ('orog', 'fx', 'fx', 'atmos'),
+             ('mrso', 'Lmon', 'mon', 'land'), ('sic', 'OImon', 'mon', 'seaIce'), ('clt', 'cfMon', 'mon', 'atmos')]
+models = [('CSIRO-BOM', 'ACCESS1-0'), ('CSIRO-BOM', 'ACCESS1-3'), ('NCAR', 'CCSM4'), ('BCC', 'bcc-csm1-1'),
+          ('MPI-M', 'MPI-ESM-LR'), ('MPI-M', 'MPI-ESM-MR'), ('NOAA-GFDL', 'GFDL-CM3'), ('MOHC', 'HadGEM2-ES'),
+          ('IPSL', 'IPSL-CM5A-LR'), ('MIROC', 'MIROC5'), ('CNRM-CERFACS', 'CNRM-CM5'), ('NCC', 'NorESM1-M')]
+experiments = ['historical', 'rcp45', 'rcp85', 'piControl', 'amip', 'abrupt4xCO2', 'decadal1980']
+# variables and experiments of the published files in the wget scripts
+wget_variables = ['tas_Amon', 'ua_Amon', 'tos_Omon', 'pr_day']
+wget_experiments = ['historical', 'rcp45']
+server = 'aims3.llnl.gov/thredds/fileServer/cmip5_data/cmip5/output1'
+
+
+def parse_input():
+    ''' Parse input arguments '''
+    parser = argparse.ArgumentParser(description='''Times the stages of the CMIP5-utils scripts on synthetic
+             inputs and writes the results as json''')
+    parser.add_argument('--lines', type=int, default=100000, help='number of paths in the file list, default 100000', required=False)
+    parser.add_argument('--tree-files', type=int, default=500, help='number of published files on the fake tree, default 500', required=False)
+    parser.add_argument('--file-size', type=int, default=1048576, help='size in bytes of the files on the fake tree, default 1MB', required=False)
+    parser.add_argument('--seed', type=int, default=1, help='random seed, default 1', required=False)
+    parser.add_argument('-w','--workdir', type=str, default='bench_CMIP5_work', help='directory for the synthetic inputs, default bench_CMIP5_work', required=False)
+    parser.add_argument('-s','--stages', type=str, nargs="*", choices=stage_names, default=stage_names, help='stages to run, default all', required=False)
+    parser.add_argument('-r','--repeat', type=int, default=1, help='run each stage this many times and keep the fastest, default 1', required=False)
+    parser.add_argument('-o','--output', type=str, default='bench_CMIP5.json', help='json results file, default bench_CMIP5.json', required=False)
+    parser.add_argument('--compare', type=str, default=None, help='json results of a previous run to compare to', required=False)
+    return vars(parser.parse_args())
+
+
+def ensemble_dirs(root, rnd):
+    ''' Yield random ensemble directories on the tree as (directory, file name prefix, number of files) '''
+    while True:
+        var, mip, frq, realm = rnd.choice(variables)
+        inst, model = rnd.choice(models)
+        exp = rnd.choice(experiments)
+        ens = 'r%di1p1' % rnd.randint(1, 5)
+        version = 'v%d%02d%02d' % (rnd.randint(2011, 2013), rnd.randint(1, 12), rnd.randint(1, 28))
+        d = '/'.join([root + server, inst, model, exp, frq, realm, mip, ens, version, var])
+        yield d, '_'.join([var, mip, model, exp, ens]), rnd.randint(1, 20)
+
+
+def published_files(rnd):
+    ''' Return the published files as (experiment, file name, url without http://) '''
+    files = []
+    for exp in wget_experiments:
+        for varmip in wget_variables:
+            var, mip = varmip.split('_')
+            frq, realm = [(v[2], v[3]) for v in variables if v[0] == var and v[1] == mip][0]
+            for inst, model in models:
+                for ens in ['r1i1p1', 'r2i1p1', 'r3i1p1']:
+                    for y in range(rnd.randint(1, 10)):
+                        fname = '%s_%s_%s_%s_%s_%d01-%d12.nc' % (var, mip, model, exp, ens, 1850 + y*10, 1859 + y*10)
+                        url = '/'.join([server, inst, model, exp, frq, realm, mip, ens, 'v20120101', var, fname])
+                        files.append((exp, fname, url))
+    return files
+
+
+def generate(params, workdir):
+    ''' Write the file list, the wget scripts and the fake tree in workdir, unless they exist with the same parameters '''
+    pfile = os.path.join(workdir, 'params.json')
+    if os.path.exists(pfile) and json.load(open(pfile)) == params:
+       print "Using inputs already in " + workdir
+       return
+    if os.path.exists(workdir): shutil.rmtree(workdir)
+    tree = os.path.join(os.path.abspath(workdir), 'tree') + '/'
+    os.makedirs(tree)
+    rnd = random.Random(params['seed'])
+    t0 = time.time()
+# the published files, those on the fake tree are listed first in the file list
+    files = published_files(rnd)
+    ntree = min(params['tree_files'], len(files))
+    ontree = rnd.sample(range(len(files)), ntree)
+    block = os.urandom(params['file_size'])
+    out = open(os.path.join(workdir, 'paths.txt'), 'w')
+    checksums = {}
+    nlines = 0
+    for n, i in enumerate(ontree):
+        exp, fname, url = files[i]
+# 10% of the files are modified on tree, 10% are under the old server name
+        data = (fname + block)[:params['file_size']]
+        hash_type = rnd.choice(['MD5', 'SHA256'])
+        checksums[i] = (hash_type, hashlib.new(hash_type.lower(), data).hexdigest())
+        if n % 10 == 1: data = data[:-1] + 'x'
+        if n % 10 == 2: url = url.replace('aims3.llnl.gov', 'pcmdi9.llnl.gov')
+        path = tree + url
+        if not os.path.isdir(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        out.write(path + '\n')
+        nlines += 1
+# fill the file list up to the number of lines requested with random ensembles
+    dirs = ensemble_dirs(tree, rnd)
+    while nlines < params['lines']:
+        d, prefix, nfiles = dirs.next()
+        for y in range(min(nfiles, params['lines'] - nlines)):
+            out.write('%s/%s_%d01-%d12.nc\n' % (d, prefix, 1850 + y*10, 1859 + y*10))
+            nlines += 1
+    out.close()
+# the wget scripts list all the published files, those not on tree have a random checksum
+    for exp in wget_experiments:
+        out = open(os.path.join(workdir, 'wget_' + exp + '.out'), 'w')
+        out.write('#!/bin/bash\ndownload_files="$(cat <<EOF--dataset.file.url.chksum_type.chksum\n')
+        for i, (fexp, fname, url) in enumerate(files):
+            if fexp != exp: continue
+            hash_type, digest = checksums.get(i, ('MD5', '%032x' % rnd.getrandbits(128)))
+            out.write("'%s' 'http://%s' '%s' '%s'\n" % (fname, url, hash_type, digest))
+        out.write('EOF--dataset.file.url.chksum_type.chksum\n)"\n')
+        out.close()
+    json.dump(params, open(pfile, 'w'))
+    print "Generated %d paths, %d published files, %d on tree in %.1f s" % (nlines, len(files), ntree, time.time() - t0)
+
+
+def cpu_times():
+    ''' Return the cpu time used by this process and its children '''
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+
+def run_script(args, workdir):
+    ''' Run one of the scripts in workdir, with the output in <script>.log '''
+    cmd = [sys.executable, os.path.join(script_dir, args[0])] + args[1:]
+    log = open(os.path.join(workdir, args[0] + '.log'), 'w')
+    ret = subprocess.call(cmd, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    if ret != 0:
+       raise RuntimeError(' '.join(cmd) + ' failed, see ' + log.name)
+
+
+def input_sizes(workdir):
+    ''' Set the number of paths in the file list and the urls of the published files, used to count the items of each stage '''
+    global nlines, urls
+    nlines = sum(1 for line in open(os.path.join(workdir, 'paths.txt')))
+    urls = [line.split("'")[3].replace('http://', '') for exp in wget_experiments
+            for line in open(os.path.join(workdir, 'wget_' + exp + '.out')) if line.startswith("'")]
+
+
+def stage_scan(workdir):
+    ''' Read the file list '''
+    for line in read_paths(open(os.path.join(workdir, 'paths.txt'))):
+        pass
+    return nlines, 'lines'
+
+
+def stage_parse(workdir):
+    ''' Parse all the paths in the file list '''
+    for rec in select_ensembles(read_paths(open(os.path.join(workdir, 'paths.txt'))), []):
+        pass
+    return nlines, 'lines'
+
+
+def stage_match(workdir):
+    ''' Parse the file list selecting the paths matching the same constraints used by stage_search '''
+    cons = compile_constraints(['tas', 'ua', 'pr'], [], ['historical', 'rcp45'], ['Amon'])
+    for rec in select_ensembles(read_paths(open(os.path.join(workdir, 'paths.txt'))), cons):
+        pass
+    return nlines, 'lines'
+
+
+def stage_search(workdir):
+    ''' Run search_CMIP5_replica.py on the file list '''
+    run_script(['search_CMIP5_replica.py', '-i', 'paths.txt', '-v', 'tas', '-v', 'ua', '-v', 'pr',
+                '-e', 'historical', '-e', 'rcp45', '-t', 'Amon', 'bench_search.csv'], workdir)
+    return nlines, 'lines'
+
+
+def stage_db_load(workdir):
+    ''' Run CMIP5_replica_db.py loading the whole file list in a new database '''
+    dbfile = os.path.join(workdir, 'bench_db.db')
+    for f in [dbfile, dbfile + '-wal', dbfile + '-shm']:
+        if os.path.exists(f): os.remove(f)
+    run_script(['CMIP5_replica_db.py', '-i', 'paths.txt', '-o', 'bench_db'], workdir)
+    return nlines, 'lines'
+
+
+def stage_tree_lookup(workdir):
+    ''' Index the tree from the file list and check if each published file exists '''
+    CMIP5_tree.set_tree(os.path.join(os.path.abspath(workdir), 'tree'))
+    CMIP5_tree.build_from_listing(urls, os.path.join(workdir, 'paths.txt'))
+    for url in urls:
+        CMIP5_tree.tree_exist(url)
+    return len(urls), 'files'
+
+
+def stage_hash(workdir):
+    ''' Calculate the md5 checksum of all the files on the fake tree '''
+    jobs = []
+    for d, subdirs, files in os.walk(os.path.join(workdir, 'tree')):
+        jobs.extend([(f, os.path.join(d, f), 'md5') for f in files])
+    nbytes = 0
+    for key, digest, n, fp in CMIP5_checksum.hash_files(jobs, 4):
+        nbytes += n
+    return nbytes, 'bytes'
+
+
+def stage_step2(workdir):
+    ''' Run fetch_step2.py on the wget scripts and the fake tree, without checksum cache '''
+    for f in ['bench_to_download.csv', 'bench_replica.csv', 'bench_not_published.csv', 'bench_journal.csv',
+              'step2_metrics.jsonl']:
+        if os.path.exists(os.path.join(workdir, f)): os.remove(os.path.join(workdir, f))
+    run_script(['fetch_step2.py', '-v'] + wget_variables + ['-e'] + wget_experiments +
+               ['-o', 'bench', '-t', '--tree', 'tree', '--listing', 'paths.txt', '--no-cache',
+                '--metrics', 'step2_metrics.jsonl'], workdir)
+    return len(urls), 'files'
+
+
+def step2_stages(workdir):
+    ''' Return the wall time of each stage of fetch_step2.py from its metrics, this includes the table write '''
+    stages = {}
+    for line in open(os.path.join(workdir, 'step2_metrics.jsonl')):
+        event = json.loads(line)
+        if event['event'] == 'stage': stages[event['stage']] = event['wall']
+    return stages
+
+
+def time_stage(name, workdir, repeat):
+    ''' Run a stage repeat times, return the result of the fastest run '''
+    best = None
+    for i in range(repeat):
+        t0 = time.time()
+        c0 = cpu_times()
+        items, unit = globals()['stage_' + name](workdir)
+        wall = time.time() - t0
+        cpu = cpu_times() - c0
+        if best is None or wall < best['wall']:
+           best = {'wall': round(wall, 4), 'cpu': round(cpu, 4), 'items': items, 'unit': unit,
+                   'rate': round(items / wall, 1) if wall > 0 else 0.0}
+           if name == 'step2': best['stages'] = step2_stages(workdir)
+    return best
+
+
+def git_commit():
+    ''' Return the current git commit of the scripts, if available '''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=script_dir,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, oldfile):
+    ''' Print the wall time of each stage compared to a previous result '''
+    old = json.load(open(oldfile))
+    if old.get('params') != results['params']:
+       print "Warning: " + oldfile + " was run with different parameters"
+    print "%-12s %10s %10s %8s" % ('stage', 'before(s)', 'after(s)', 'speedup')
+    for name in stage_names:
+        if name not in results['stages'] or name not in old.get('stages', {}): continue
+        before = old['stages'][name]['wall']
+        after = results['stages'][name]['wall']
+        speedup = before / after if after > 0 else 0.0
+        print "%-12s %10.3f %10.3f %7.2fx" % (name, before, after, speedup)
+
+
+def main():
+    ''' Generate the inputs, time the stages and write the results '''
+    args = parse_input()
+    params = {'lines': args["lines"], 'tree_files': args["tree_files"], 'file_size': args["file_size"], 'seed': args["seed"]}
+    workdir = args["workdir"]
+    generate(params, workdir)
+    input_sizes(workdir)
+    results = {'created': datetime.datetime.now().isoformat(), 'host': platform.node(),
+               'python': platform.python_version(), 'commit': git_commit(), 'params': params, 'stages': {}}
+    for name in stage_names:
+        if name not in args["stages"]: continue
+        results['stages'][name] = time_stage(name, workdir, args["repeat"])
+        s = results['stages'][name]
+        print "%-12s %8.3f s wall %8.3f s cpu %12d %s (%.1f/s)" % (name, s['wall'], s['cpu'], s['items'], s['unit'], s['rate'])
+    f = open(args["output"], 'w')
+    json.dump(results, f, indent=2, sort_keys=True)
+    f.close()
+    print "Results written to " + args["output"]
+    if args["compare"]: compare(results, args["compare"])
+
+
+if __name__ == '__main__':
+    main()
@@ -16,8 +16,15 @@
 # published files responding to the constraints passed as arguments.
 # The search is run on one of the ESGF node but it searches through all the available
 # nodes for the latest version. Multiple arguments can be passed to -e, -v, -m. At least one variable and experiment
-# should be specified but models are optionals. The search is limited to the first 10000 matches,
-# to change this you have to change the pcmdi_url variable in the code.
+# should be specified but models are optionals. Results are requested in pages of 10000 files (change with -l/--limit)
+# until all the matching files are found. Experiments are searched at the same time, up to --threads (default 4),
+# requests that fail because of network or server errors are retried.
+# With "-b search" the file records are retrieved from the search service in json format instead of a wget script,
+# and saved in files_<experiment>.csv with filename, url, checksum, checksum type, size and version of each file.
+# fetch_step2.py -b search reads these files. Search responses are cached in ~/.CMIP5_esgf_cache for 24 hours
+# (change with --cache-dir and --ttl), so repeating a search or searching a subset of the same variables/models
+# doesn't need to query the node again.
+# --metrics FILE appends the time taken by the queries and the number of files found as json lines.
 # The second step returns 3 files listing: the published files available on raijin (variables_replica.csv), 
 # the published files that need downloading and/or updating (variables_to_download.csv), 
 # the variable/model/experiment combination not yet published (variables_not_published).
@@ -37,32 +44,45 @@
 #  - multiple arguments can be passed to "-v", "-m", "-e";
 #  - to pass multiple arguments, declare the option once followed by all desired values (as above);
 #  - you need to pass at least one experiment and one variable, models are optional.
-#  - node is optional, dkrz is default, only other option is pcmdi
+#  - node is optional, dkrz is default, other options are pcmdi or the url of any esg-search service
 
 import sys, urllib
 import os.path as opath     # to manage files and dirs
 import argparse             # to parse input arguments
+from CMIP5_parser import VarCmipTable, split_varmip
+import CMIP5_esgf
+import CMIP5_metrics
+from CMIP5_metrics import stage
+from CMIP5_esgf import node_url, query_params, fetch_all, query_atoms, search_records, write_records
 
 # help functions
-def VarCmipTable(v):
-    if "_" not in v:
-      raise TypeError("String '%s' does not match required format: var_cmip-table, ie tas_Amon"%(v,))
-    else:
-      return v
-
 def parse_input():
     ''' Parse input arguments '''
     parser = argparse.ArgumentParser(description='''Retrieves a wget script (wget_<experiment>.out) listing all the CMIP5 
             published files responding to the constraints passed as arguments.
             The search is run on one of the ESGF node but it searches through all the available 
             nodes for the latest version. Multiple arguments can be passed to -e, -v, -m. At least one variable and experiment 
-            should be specified but models are optionals. The search is limited to the first 1000 matches,
-            to change this you have to change the pcmdi_url variable in the code.''')
+            should be specified but models are optionals. Results are requested in pages of --limit files,
+            until all the matching files are found.''')
     parser.add_argument('-e','--experiment', type=str, nargs="*", help='CMIP5 experiment', required=True)
     parser.add_argument('-m','--model', type=str, nargs="*", help='', required=False)
     parser.add_argument('-v','--variable', type=VarCmipTable, nargs="*", help='combination of CMIP5 variable & cmip_table Ex. tas_Amon', required=True)
-    parser.add_argument('-n','--node', type=str, nargs=1, default='dkrz', help='''ESGF node to use for the search, 
-                        default is dkrz, pcmdi other option ''', required=False)
+    parser.add_argument('-n','--node', type=str, nargs=1, default=['dkrz'], help='''ESGF node to use for the search, 
+                        default is dkrz, pcmdi other option, or the url of an esg-search service''', required=False)
+    parser.add_argument('-l','--limit', type=int, default=10000, help='''number of files requested at once,
+                        the search continues until all files are found, default is 10000''', required=False)
+    parser.add_argument('--threads', type=int, default=4, help='''number of requests run at the same time,
+                        default is 4''', required=False)
+    parser.add_argument('-b','--backend', type=str, choices=['wget','search'], default='wget', help='''wget (default)
+                        retrieves wget_<experiment>.out scripts, search retrieves the file records in json format
+                        and saves them in files_<experiment>.csv''', required=False)
+    parser.add_argument('--cache-dir', type=str, default=CMIP5_esgf.cache_dir, help='''directory where search backend
+                        responses are cached, default is ~/.CMIP5_esgf_cache''', required=False)
+    parser.add_argument('--ttl', type=float, default=24, help='''hours after which a cached response is requested
+                        again, default is 24, 0 disables the cache''', required=False)
+    parser.add_argument('--metrics', type=str, default=None, help='''append the run metrics (time of each stage,
+                        counters) as json lines to this file''', required=False)
+    parser.add_argument('--verbose', type=int, default=1, help='0 prints only warnings, default 1 also prints stages', required=False)
     return vars(parser.parse_args())
 
 
@@ -81,35 +101,39 @@ def correct_model(model):
 
 
 def create_wget(exp,modlist,varmips,node):
-    ''' create wget call for each query (ie each variable/exp/model combination) '''
+    ''' create wget query for each experiment (ie each variable/exp/model combination) '''
     wgetfile = "wget_" + exp + ".out"
 # if one of the wget output files exists issue a warning an exit
     if opath.isfile(wgetfile):
        print "Warning: one of the output files exists, exit to not overwrite!"
        sys.exit() 
 # apply recursively correct_model to each input model
-    models = ""
-    if len(modlist) > 0:
-      modlist = map(correct_model, [x for x in modlist])
-      models = "&model=" + "&model=".join(modlist) 
+    modlist = map(correct_model, [x for x in modlist])
 # split var and mip table varmips
-    varlist = list(set([i.split("_")[0] for i in varmips]))
-    miplist = list(set([i.split("_")[1] for i in varmips]))
-    mips = "&cmor_table=".join(miplist) 
-    variables = "&variable=".join(varlist) 
-# builds url to be passed depending on constraints and chosen node 
-    pcmdi_url = "http://esgf-data.dkrz.de/esg-search/wget?experiment=" + exp + "&cmor_table=" + mips + "&project=CMIP5" + models + "&variable=" + variables + "&replica=false&latest=true&limit=10000"
-#    pcmdi_url = "http://esgf-data.dkrz.de/esg-search/wget?experiment=" + exp + "&cmor_table=" + mips + "&project=CMIP5" + models + "&variable=" + variables + "&replica=false&latest=true&limit=10000&offset=10000"
-    if node=='pcmdi': pcmdi_url = "http://pcmdi.llnl.gov/esg-search/wget?experiment=" + exp + "&cmor_table=" + mips + "&project=CMIP5" + models + "&variable=" + variables + "&replica=false&latest=true&limit=10000"
-    print pcmdi_url 
-    urllib.urlretrieve(pcmdi_url,wgetfile)
-    print "Finished downloading wget file from " + pcmdi_url.split("/")[2]
-    return wgetfile 
+    varlist = list(set([split_varmip(i)[0] for i in varmips]))
+    miplist = list(set([split_varmip(i)[1] for i in varmips]))
+# builds query to be passed depending on constraints and chosen node 
+    base = node_url(node)
+    params = query_params(exp,modlist,varlist,miplist)
+    print base + "wget?" + urllib.urlencode(params)
+    return wgetfile, (base, params, limit)
+
+
+def create_records(exp,modlist,varmips,node):
+    ''' create the search queries for an experiment, one for each var_cmip-table and model '''
+    recfile = "files_" + exp + ".csv"
+# if one of the output files exists issue a warning an exit
+    if opath.isfile(recfile):
+       print "Warning: one of the output files exists, exit to not overwrite!"
+       sys.exit() 
+    modlist = map(correct_model, [x for x in modlist])
+    base = node_url(node)
+    return recfile, [(base, params, limit) for params in query_atoms(exp,modlist,varmips)]
 
 
 def assign_constraint():
     ''' Assign default values and input to constraints '''
-    global var0, exp0, mod0, node 
+    global var0, exp0, mod0, node, limit, nthreads, backend
     var0 = []
     exp0 = []
     mod0 = []
@@ -119,6 +143,18 @@ def assign_constraint():
     if args["model"]: mod0=args["model"]
     exp0=args["experiment"] 
     node=args["node"][0] 
+# check the node before any query is built
+    try:
+       node_url(node)
+    except CMIP5_esgf.ESGFError as e:
+       sys.exit(str(e))
+    limit=args["limit"]
+    nthreads=args["threads"]
+    backend=args["backend"]
+    CMIP5_esgf.cache_dir=args["cache_dir"]
+    CMIP5_esgf.ttl=args["ttl"]*3600
+    CMIP5_metrics.setup(args["metrics"], args["verbose"])
+    if args["ttl"] <= 0: CMIP5_esgf.cache_dir=None
     return
 
 
@@ -126,9 +162,38 @@ def main():
     ''' Main program starts here '''
 # read inputs and assign constraints
     assign_constraint()
-# loop through experiments, 1st create a wget request for exp, then parse_file 
-    for exp in exp0:
-        wgetfile=create_wget(exp,mod0,var0,node)
+# search backend: run all the queries concurrently and write the records of each experiment to a csv file
+    if backend == 'search':
+       queries = [create_records(exp,mod0,var0,node) for exp in exp0]
+       with stage("search") as st:
+           results = fetch_all([task for q in queries for task in q[1]], nthreads, search_records)
+           st['items'] = sum([len(q[1]) for q in queries])
+       nfiles = 0
+       for recfile, tasks in queries:
+           records = []
+           urls = set()
+           for recs in results[0:len(tasks)]:
+               records.extend([r for r in recs if r[1] not in urls])
+               urls.update([r[1] for r in recs])
+           results = results[len(tasks):]
+           write_records(recfile, records)
+           nfiles += len(records)
+           print "Written " + str(len(records)) + " file records to " + recfile
+       CMIP5_metrics.summary(queries=sum([len(q[1]) for q in queries]), files=nfiles)
+       return
+# loop through experiments, 1st create a wget request for exp, then run them all concurrently
+    queries = [create_wget(exp,mod0,var0,node) for exp in exp0]
+    with stage("wget") as st:
+        scripts = fetch_all([q[1] for q in queries], nthreads)
+        st['items'] = len(queries)
+    nfiles = 0
+    for (wgetfile, query), script in zip(queries, scripts):
+        wget = open(wgetfile, "w")
+        wget.write(script)
+        wget.close()
+        nfiles += len(CMIP5_esgf.file_lines(script))
+        print "Finished downloading " + wgetfile + " from " + query[0].split("/")[2]
+    CMIP5_metrics.summary(queries=len(queries), files=nfiles)
 
 # check python version and then call main()
 if sys.version_info < ( 2, 7):
@@ -16,17 +16,56 @@
 # published files responding to the constraints passed as arguments.
 # The search is run on one of the ESGF node but it searches through all the available
 # nodes for the latest version. Multiple arguments can be passed to -e, -v, -m. At least one variable and experiment
-# should be specified but models are optionals. The search is limited to the first 10000 matches,
-# to change this you have to change the pcmdi_url variable in the code.
+# should be specified but models are optionals. Results are requested in pages until all the matching files are found.
 # The second step returns 3 files listing: the published files available on raijin (variables_replica.csv),
 # the published files that need downloading and/or updating (variables_to_download.csv),
 # the variable/model/experiment combination not yet published (variables_not_published).
 # Uses md5/sha256 checksum to determine if a file already existing on raijin is exactly the same as the latest published version
-# If you have to parse a big number of files, you can speed up the process by using multithread module "Pool"
+# The files on the tree are indexed once at the start, by default reading the weekly list of files on the tree
+# esg-tree-LATEST-paths.txt, so checking if a file exists doesn't need to access the file system. Use --tree-index scan
+# to list the directories of the published files instead (finds files added after the list was updated), or
+# --tree-index none to check each file. --tree sets a different tree root directory and --listing a different list.
+# With -b search the file list is read from the files_<experiment>.csv records written by fetch_step1.py -b search,
+# instead of parsing the wget scripts.
+# Files on tree are compared to the published ones in tiers, from the cheapest to the most expensive check:
+# a version directory older than the published version or a different size (both only known with -b search, with wget
+# scripts the published version is read from the url itself) marks the file for update without reading it,
+# then a checksum from the cache is used and only the remaining files are hashed.
+# With --quick a file whose mtime or inode changed since its checksum was cached, but with the same size and the same
+# fingerprint (first and last 1MB), is accepted using the cached checksum without reading it all. A random sample of
+# these files, set by --sample (default 0.01), is still fully hashed. --defer FILE lists the other quick checked files,
+# so they can be fully hashed later by a low priority job:  python CMIP5_checksum.py FILE
+# The number of files decided by each tier is printed at the end, the journal lists the tier that decided each file.
+# The replica and download files are written as soon as each file is checked, only the combinations found and the
+# counts needed for the not published file and the table are kept in memory. The files waiting to be hashed are written
+# to a temporary file and hashed 10000 at the time, the file lists and the index of the tree are still kept in memory.
+# Checksums are calculated with python hashlib on multiple threads, set by the --threads option (default same as --workers).
+# Files are hashed grouped by directory, with at most --max-large files bigger than 512MB read at the same time
+# (default half the threads) while the other threads hash the smaller files. --max-rate limits the total reading
+# speed in MB/s, to avoid overloading the shared filesystem.
+# Checksums are cached in ~/.CMIP5_checksum_cache.db, so files that haven't changed since a previous run are not hashed again;
+# use --cache to choose a different cache file, --cache-size to limit its number of entries and --no-cache to disable it.
+# If you have to parse a big number of files, you can speed up the process by using more workers,
 # if you're doing this you should run the second step in the queue, which is the reason why the script is split into 2 steps.
-# To do that you can change the threads number from 1 (to run interactively) to the number of cpus you're requesting, in line 340 
-#           async_results = Pool(16).map_async(process_file, result)
-# The maximum number of threads depends on the number of cpus you're using, in above example 16 cpus.
+# The number of worker processes is set by the --workers option, by default it is the number of cpus requested 
+# to PBS (NCPUS) or, if not running in the queue, the number of cpus available to the script. To run interactively use
+#           python fetch_step2.py ... --workers 1
+# --chunksize sets how many files are sent to a worker at once, default is calculated from number of files and workers.
+# The outcome of each file checked is appended to a journal (<output>_journal.csv, change with --journal) as soon
+# as it is known. If a run is interrupted, for example by the PBS walltime, run it again with the same arguments and
+# --resume: files already in the journal are not checked again and the outputs, partial if the run was interrupted
+# while writing them, are written again using all the results.
+# To split a big check between nodes run it as a PBS array job with --shard I/N (I from 1 to N): each job checks
+# only the files whose url falls in shard I, chosen by a hash of the url so all jobs agree without talking to each
+# other, and writes its results only to its journal (<output>_shard<I>of<N>_journal.csv). When all jobs are finished
+# merge the journals to write the usual outputs, passing the same constraints:
+#           #PBS -J 1-4
+#           python fetch_step2.py -v tas_Amon -e historical -o out --shard $PBS_ARRAY_INDEX/4
+#           python fetch_step2.py -v tas_Amon -e historical -o out -t --merge out_shard*of4_journal.csv
+# The merge reads the file lists again and warns about files missing from the journals, for example of a shard
+# interrupted by the walltime (run it again with --resume), those files are not included in the outputs.
+# --metrics FILE appends the time of each stage, the counters of files checked and hashed and the progress, as json lines.
+# --verbose 2 prints each file checked, 0 only warnings, default 1 prints the stages and the progress with an ETA.
 #
 # If the "table" option is selected it returns also a table csv file summarising the search results. 
 #
@@ -47,17 +86,42 @@
 #  - output file is optional, default is "variables"
 #  - table is optional, default is False
 
-import sys, argparse
-import subprocess, re, itertools
-from multiprocessing import Pool
+import sys, argparse, zlib, random, tempfile
+import itertools
+from multiprocessing import Pool, cpu_count
+import os
 import os.path as opath     # to manage files and dirs
+from CMIP5_parser import VarCmipTable, file_details, find_version, version_date
+from CMIP5_esgf import read_records
+import CMIP5_tree
+from CMIP5_tree import tree_exist
+import CMIP5_checksum
+from CMIP5_checksum import file_key, cache_get, cache_put, evict_cache, hash_files, hash_report, hash_stats
+from CMIP5_checksum import cache_quick, cache_touch
+import CMIP5_metrics
+from CMIP5_metrics import stage, progress, log
+
+# number of files read at the time from the spool of the files to hash, each batch is scheduled by CMIP5_checksum
+hash_batch = 10000
 
 # help functions
-def VarCmipTable(v):
-    if "_" not in v:
-      raise TypeError("String '%s' does not match required format: var_cmip-table, ie tas_Amon"%(v,))
-    else:
-      return v
+def default_workers():
+    ''' Return number of cpus to use: NCPUS if running in PBS queue, otherwise cpus this process can run on '''
+    if os.environ.get("NCPUS"):
+       return int(os.environ["NCPUS"])
+# cpu affinity of the process, as listed in /proc/self/status ex. "Cpus_allowed_list:   0-3,8"
+    try:
+       for line in open("/proc/self/status"):
+           if line.startswith("Cpus_allowed_list:"):
+              ncpus = 0
+              for cpus in line.split()[1].split(","):
+                  first, last = (cpus.split("-") + [cpus])[0:2]
+                  ncpus += int(last) - int(first) + 1
+              return ncpus
+    except (IOError, ValueError):
+       pass
+    return cpu_count()
+
 
 def parse_input():
     ''' Parse input arguments '''
@@ -65,8 +129,7 @@ def parse_input():
             published files responding to the constraints passed as arguments.
             The search is run on one of the ESGF node but it searches through all the available
             nodes for the latest version. Multiple arguments can be passed to -e, -v, -m. At least one variable and experiment
-            should be specified but models are optionals. The search is limited to the first 1000 matches,
-            to change this you have to change the pcmdi_url variable in the code.''')
+            should be specified but models are optionals.''')
     parser.add_argument('-e','--experiment', type=str, nargs="*", help='CMIP5 experiment', required=True)
     parser.add_argument('-m','--model', type=str, nargs="*", help='', required=False)
     parser.add_argument('-v','--variable', type=VarCmipTable, nargs="*", help='combination of CMIP5 variable & cmip_table Ex. tas_Amon', required=True)
@@ -74,6 +137,50 @@ def parse_input():
                         required=False)
     parser.add_argument('-o','--output', type=str, nargs="?", default="variables", help='''output files root, 
                        default is variables''', required=False)
+    parser.add_argument('-b','--backend', type=str, choices=['wget','search'], default='wget', help='''wget (default)
+                       reads the file list from wget_<experiment>.out, search from files_<experiment>.csv, 
+                       as retrieved by fetch_step1.py with the same option''', required=False)
+    parser.add_argument('--tree', type=str, default=CMIP5_tree.tree_root, help='''root directory of the replica tree,
+                       default is /g/data1/ua6/unofficial-ESG-replica/tmp/tree/''', required=False)
+    parser.add_argument('--tree-index', type=str, choices=['listing','scan','none'], default='listing', help='''how to
+                       check that files exist on the tree: listing (default) reads the weekly list of files on the tree,
+                       scan lists the directories of the published files, none checks each file''', required=False)
+    parser.add_argument('--listing', type=str, default=None, help='''list of files on tree used by --tree-index listing,
+                       default is esg-tree-LATEST-paths.txt in the tree root''', required=False)
+    parser.add_argument('-w','--workers', type=int, default=default_workers(), help='''number of worker processes,
+                       default is PBS NCPUS or the number of cpus available''', required=False)
+    parser.add_argument('--chunksize', type=int, default=None, help='''number of files passed to a worker at once,
+                       default is calculated from the number of files''', required=False)
+    parser.add_argument('--threads', type=int, default=None, help='''number of threads used to calculate the checksums
+                       of the files on the tree, default is same as workers''', required=False)
+    parser.add_argument('--max-large', type=int, default=None, help='''maximum number of files bigger than 512MB
+                       hashed at the same time, default is half the threads''', required=False)
+    parser.add_argument('--max-rate', type=float, default=None, help='''maximum total reading speed in MB/s
+                       when calculating checksums, default is no limit''', required=False)
+    parser.add_argument('--cache', type=str, default=CMIP5_checksum.cache_file, help='''sqlite file used to cache
+                       the checksums of files on the tree, default is ~/.CMIP5_checksum_cache.db''', required=False)
+    parser.add_argument('--no-cache', action='store_true', default=False, help="don't use the checksum cache",
+                        required=False)
+    parser.add_argument('--cache-size', type=int, default=1000000, help='''maximum number of entries in the checksum 
+                       cache, least recently used are evicted, default is 1000000''', required=False)
+    parser.add_argument('--quick', action='store_true', default=False, help='''accept the cached checksum of files
+                       with changed mtime or inode if their size and first and last 1MB are the same''', required=False)
+    parser.add_argument('--sample', type=float, default=0.01, help='''fraction of the quick checked files that are
+                       fully hashed anyway, default 0.01''', required=False)
+    parser.add_argument('--defer', type=str, default=None, help='''file where the quick checked files not in the
+                       sample are listed, to be fully hashed later by CMIP5_checksum.py''', required=False)
+    parser.add_argument('--journal', type=str, default=None, help='''file where the outcome of each file is
+                       recorded as soon as it is checked, default is <output>_journal.csv''', required=False)
+    parser.add_argument('--resume', action='store_true', default=False, help='''continue an interrupted run, files
+                       already in the journal are not checked again''', required=False)
+    parser.add_argument('--shard', type=str, default=None, help='''check only shard I of N of the files, as I/N,
+                       results are written only to the journal''', required=False)
+    parser.add_argument('--merge', type=str, nargs="+", default=None, help='''write the outputs from the journals
+                       of the shards, without checking any file''', required=False)
+    parser.add_argument('--metrics', type=str, default=None, help='''append the run metrics (time of each stage,
+                       counters, progress) as json lines to this file''', required=False)
+    parser.add_argument('--verbose', type=int, default=1, help='''0 prints only warnings, 1 (default) also stages and
+                       progress, 2 also prints each file checked''', required=False)
     return vars(parser.parse_args())
 
     sys.exit()
@@ -81,7 +188,8 @@ def parse_input():
 
 def assign_constraint():
     ''' Assign default values and input to constraints '''
-    global var0, exp0, mod0, table, outfile
+    global var0, exp0, mod0, table, outfile, nthreads, nworkers, chunksize, backend, tree_index, listfile
+    global jfile, resume, shard, merge, max_large, max_rate, quick, sample, deferfile
     var0 = []
     exp0 = []
     mod0 = []
@@ -93,6 +201,38 @@ def assign_constraint():
     exp0=args["experiment"]
     table=args["table"]
     outfile=args["output"]
+    backend=args["backend"]
+    CMIP5_tree.set_tree(args["tree"])
+    tree_index=args["tree_index"]
+    listfile=args["listing"]
+    if not listfile: listfile=CMIP5_tree.tree_root + "esg-tree-LATEST-paths.txt"
+    nworkers=max(1,args["workers"])
+    chunksize=args["chunksize"]
+    nthreads=args["threads"]
+    max_large=args["max_large"]
+    max_rate=None
+    if args["max_rate"]: max_rate=args["max_rate"] * 1e6
+    if not nthreads: nthreads=nworkers
+    cache=args["cache"]
+    if args["no_cache"]: cache=None
+    CMIP5_checksum.open_cache(cache, args["cache_size"])
+    quick=args["quick"]
+    sample=args["sample"]
+    deferfile=args["defer"]
+    CMIP5_metrics.setup(args["metrics"], args["verbose"])
+    shard=None
+    if args["shard"]:
+       try:
+          shard=[int(x) for x in args["shard"].split("/")]
+       except ValueError:
+          shard=[]
+       if len(shard) != 2 or not 1 <= shard[0] <= shard[1]:
+          sys.exit("Shard should be passed as I/N with I between 1 and N, ex. 2/4")
+    merge=args["merge"]
+    jfile=args["journal"]
+    if not jfile and shard: jfile=outfile + "_shard%dof%d_journal.csv" % tuple(shard)
+    if not jfile: jfile=outfile + "_journal.csv"
+    resume=args["resume"]
     return
 
 
@@ -110,47 +250,26 @@ def correct_model(model):
     return model
 
 
-def tree_exist(furl):
-    '''  Return True if file exists in tmp/tree '''
-    replica_dir = "/g/data1/ua6/unofficial-ESG-replica/tmp/tree/"
-    tree_path = replica_dir + furl 
-    return [opath.exists(tree_path),tree_path]
-
- 
-def write_file():
-    ''' Write info on file to download or replica output '''
-    global info
-    files = {"R" : orep, "D" : odown}
-    for item in info.values():
-        outfile = files[item[-1]]
-        outfile.write(",".join(item[0:-1])+"\n")
-
-
-def file_details(fname):
-    ''' Split the filename in variable, MIP code, model, experiment, ensemble (period is excluded) '''
-    namebits = fname.replace("'","").split('_')
-    if len(namebits) >= 5:
-      details = namebits[0:5]
-    else:
-      details = []
-    return details
-
-
-def find_string(bits,string):
-    ''' Returns matching string if found in directory structure '''
-    dummy = filter(lambda el: re.findall( string, el), bits)
-    if len(dummy) == 0:
-        return 'no_version'
-    else:
-        return dummy[0]
+def add_result(finfo):
+    ''' Write info on file to download or replica output as soon as its status is known, keep only
+        the var_mip/model/exp combinations found and the counts for the table, in the index
+        {(var_mip, exp): {(mod, ens, ver): [number of files, number of files to download/update]}} '''
+    global nfiles
+    # info order is: 0-var, 1-mip, 2-mod, 3-exp, 4-ens, 5-ver, 6-fname, 7-status
+    nfiles += 1
+    if outputs: outputs[finfo[-1]].write(",".join(finfo[0:-1])+"\n")
+    var_mip = finfo[0] + "_" + finfo[1]
+    found.add((var_mip, finfo[2], finfo[3]))
+    counts = findex.setdefault((var_mip, finfo[3]), {}).setdefault((finfo[2], finfo[4], finfo[5]), [0, 0])
+    counts[0] += 1
+    if finfo[-1] == "D": counts[1] += 1
 
 
 def get_info(fname,path):
     ''' Collect the info on a file form its path return it in a list '''
-    version = '[a-z]*201[0-9][0-1][0-9][0-3][0-9]'
     bits = path.split('/')
     finfo = file_details(fname)
-    finfo.append(find_string(bits[:-1],version)) 
+    finfo.append(find_version(bits[:-1],'no_version'))
     finfo.append(path) 
     return finfo
 
@@ -158,89 +277,233 @@ def get_info(fname,path):
 
 def parse_file(wgetfile,varlist,modlist,exp):
     ''' extract file list from wget file '''
-# open wget file, read content saving to a list of lines and close again
+# var_mip and model lookups are frozensets, model is not checked if modlist is empty
+    varset = frozenset(varlist)
+    modset = frozenset(modlist)
+    result=[]
+# read wget file one line at the time, the file lines are the ones starting with a quote:
+#  'filename' 'url' 'checksum type' 'checksum'
     infile = open(wgetfile,'r')
-    lines = infile.readlines()
-    infile.close
+    for line in infile:
 # if wget didn't return files print a warning and exit function 
-    if lines[0] == "No files were found that matched the query":
-       print lines[0] + " for ", varlist, modlist, exp
-       return False 
+        if line.startswith("No files were found that matched the query"):
+           print line.rstrip() + " for ", varlist, modlist, exp
+           infile.close()
+           return False 
+        if line[0] != "'": continue
+        bits = line.replace("'","").split()
+        if len(bits) != 4: continue
+        [fname,furl,hash_type,fhash] = bits
+# split filename in var, mip, model, exp, ensemble and select only files matching the constraints
+        details = file_details(fname)
+        if not details or details[3] != exp: continue
+        if details[0] + "_" + details[1] not in varset: continue
+        if modset and details[2] not in modset: continue
+        if hash_type in ["SHA256","sha256","md5","MD5"]:
+           result.append([fname, furl.replace("http://",""), fhash, hash_type])
+        else: 
+           print "Error in parse_file() is selecting the wrong lines!"
+           print line
+           sys.exit()
+    infile.close()
+    return result 
+
+
+def load_records(recfile,varlist,modlist,exp):
+    ''' extract file list from the file records saved by fetch_step1.py -b search '''
+    varset = frozenset(varlist)
+    modset = frozenset(modlist)
+    result=[]
+    for [fname,furl,fhash,hash_type,size,version] in read_records(recfile):
+# select only files matching the constraints, same as parse_file
+        details = file_details(fname)
+        if not details or details[3] != exp: continue
+        if details[0] + "_" + details[1] not in varset: continue
+        if modset and details[2] not in modset: continue
+        if hash_type not in ["SHA256","sha256","md5","MD5"]:
+           print "Warning: no valid checksum for " + furl + ", file is skipped"
+           continue
+        result.append([fname, furl.replace("http://",""), fhash, hash_type, size, version])
+    if not result:
+       print "No files were found that matched the query for ", varlist, modlist, exp
+       return False
+    return result 
+
+
+def set_status(finfo,furl,same):
+    ''' Add status to file info: R if file on tree is the same as published one, 
+        otherwise D and the tree path is substituted by the file url '''
+    if same:
+       finfo.append("R")
     else:
-# select only the files lines starting as var_cmortable_model_exp ...
-       result=[]
-# if modlist empty add to it a regex string indicating model name
-       if len(modlist) > 0:
-          comb_constr = itertools.product(*[varlist,modlist])
-          filestrs = ["_".join(x) for x in comb_constr]
-       else:
-          filestrs = [var + '_[A-Za-z0-9-.()]*_' for var in varlist] 
-       for line in lines:
-           match = [re.search(pat,line) for pat in filestrs]
-           if match.count(None) != len(match) and line.find(exp):
-              [fname,furl,hash_type,fhash] = line.replace("'","").split()
-              if hash_type in ["SHA256","sha256","md5","MD5"]:
-                 result.append([fname, furl.replace("http://",""), fhash, hash_type])
-              else: 
-                 print "Error in parse_file() is selecting the wrong lines!"
-                 print line
-                 sys.exit()
-       return result 
-    
-
-def check_hash(tree_path,fhash,hash_type):
-    ''' Execute md5sum/sha256sum on file on tree and return True,f same as in wget file '''
-    hash_cmd="md5sum"
-    if hash_type in ["SHA256","sha256"]: hash_cmd="sha256sum"
-    tree_hash = subprocess.check_output([hash_cmd, tree_path]).split()[0]
-    return tree_hash == fhash
+       finfo[-1] = "http://" + furl
+       finfo.append("D")
+    return finfo
+
+
+def spool_write(spool, tohash, tier, cached):
+    ''' Write a file to hash to the spool file, return its size '''
+    [furl,tree_path,fhash,hash_type,key] = tohash
+    spool.write(",".join([furl, tree_path, fhash, hash_type, str(key[0]), repr(key[1]), str(key[2]), tier,
+                          cached or ""]) + "\n")
+    return key[0]
+
+
+def spool_read(spool):
+    ''' Yield the files to hash written to the spool file, as [furl,tree_path,fhash,hash_type,key,tier,cached] '''
+    spool.seek(0)
+    for line in spool:
+        [furl,tree_path,fhash,hash_type,size,mtime,inode,tier,cached] = line.rstrip("\n").split(",")
+        yield [furl, tree_path, fhash, hash_type, (int(size), float(mtime), int(inode)), tier, cached or None]
+
+
+def check_hash(spool, total):
+    ''' Calculate md5/sha256 hash of the files on tree in the spool file on multiple threads and set their status,
+        comparing the hash with the value in wget file. Hashes are added to the checksum cache.
+        Files are read from the spool hash_batch at the time, total is the number of bytes to hash '''
+    done = 0
+    files = spool_read(spool)
+    while True:
+        jobs = dict((x[0], x) for x in itertools.islice(files, hash_batch))
+        if not jobs: break
+# the fingerprints for the quick check are calculated while hashing, only if they can be cached
+        for furl, tree_hash, nbytes, fprint in hash_files([(x[0], x[1], x[3], x[4][0]) for x in jobs.values()], nthreads,
+                                                          max_large, max_rate, bool(CMIP5_checksum.cache_file)):
+            done += jobs[furl][4][0]
+            hash_result(jobs[furl], tree_hash, fprint)
+            progress("hash", done, total, "bytes")
+    log(1, hash_report())
+    return
+
+
+def hash_result(job, tree_hash, fprint):
+    ''' Set the status of a file from its hash, add the hash to the cache and the file to the outputs and the journal '''
+    [furl,tree_path,fhash,hash_type,key,tier,cached] = job
+    if tree_hash is not None:
+       cache_put(tree_path,hash_type,key,tree_hash,fprint)
+# a sampled file should have the checksum accepted by the quick check
+    if tier == "sample" and tree_hash != cached:
+       print "Warning: " + tree_path + " passed the quick check but its checksum is different"
+# the file info is not kept while the file waits to be hashed, it is rebuilt from the url and tree path
+    finfo = set_status(get_info(furl.split("/")[-1],tree_path),furl,tree_hash == fhash)
+    add_result(finfo)
+    journal_write(furl, tree_path, finfo[-1], tier, tree_hash)
+    return
 
 
 def process_file(result):
-    ''' Check if file exist on tree and if True check md5/sha265 hash '''
+    ''' Check if file exist on tree and classify it using the cheapest information available:
+        version of the tree directory, size of the file, md5/sha256 hash in cache, with --quick size and fingerprint.
+        Return file info, the details to calculate the hash if the file needs hashing, the tier that decided
+        its status, the path on tree and the cached hash if it was used '''
     info = {}
-    [fname,furl,fhash,hash_type]=result
+    tohash = None
+    [fname,furl,fhash,hash_type]=result[0:4]
+# size and version of the published file are known only from search records
+    size, version = (result[4:6] + [None, None])[0:2]
+    if not version: version = find_version(furl.split('/')[:-1], None)
+# some servers have updated name: for ex pcmdi9.llnl.gov is now aims3.llnl.gov, tree_exist checks those too
     [bool,tree_path]=tree_exist(furl)
-# some servers have updated name: for ex pcmdi9.llnl.gov is now aims3.llnl.gov so we need to substitute and check that too
-    print furl, bool
-    if not bool and furl[0:14]=='aims3.llnl.gov':
-         for num in [3,7,9]:
-           other_furl=furl.replace('aims3','pcmdi'+str(num)) 
-           print "other_furl  ", other_furl
-           [bool,tree_path]=tree_exist(other_furl)
-           if bool:
-              print "bool after extra check for num ", bool, num
-              break
+    log(2, furl, bool)
     info[furl] = get_info(fname,tree_path)
 # if file exists in tree compare md5/sha256 with values in wgetfile, else add to update
-    if "ACCESS" in fname or "CSIRO" in fname or (bool and check_hash(tree_path,fhash,hash_type)):
-       info[furl].append("R")
-    else:
-       info[furl][-1] = "http://" + furl
-       info[furl].append("D")
-    return  info
+    if "ACCESS" in fname or "CSIRO" in fname:
+       set_status(info[furl],furl,True)
+       return info, tohash, "not_checked", tree_path, None
+    if not bool:
+       set_status(info[furl],furl,False)
+       return info, tohash, "not_on_tree", tree_path, None
+# a version directory on tree older than the published version needs updating, no need to read the file.
+# With the wget backend the published version comes from the url, the same as the tree path, so this tier never
+# decides a file: only the search records (-b search) have the dataset version, which can be newer than the url path
+    tree_date = version_date(info[furl][5])
+    pub_date = version_date(version)
+    if tree_date and pub_date and tree_date < pub_date:
+       set_status(info[furl],furl,False)
+       return info, tohash, "version", tree_path, None
+# the listing can be older than the tree, a file listed may have been removed since
+    try:
+       key = file_key(tree_path)
+    except OSError:
+       set_status(info[furl],furl,False)
+       return info, tohash, "not_on_tree", tree_path, None
+# a file with a different size can't have the same checksum
+    if size and size.isdigit() and int(size) != key[0]:
+       set_status(info[furl],furl,False)
+       return info, tohash, "size", tree_path, None
+    tree_hash = cache_get(tree_path,hash_type,key)
+    tier = "cache"
+    if tree_hash is None and quick:
+       tree_hash = cache_quick(tree_path,hash_type,key)
+       tier = "quick"
+# a random sample of the quick checked files is fully hashed, to catch changes the fingerprint misses
+       if tree_hash is not None and random.random() < sample:
+          tohash = [furl,tree_path,fhash,hash_type,key]
+          return info, tohash, "sample", tree_path, tree_hash
+    if tree_hash is None:
+       tohash = [furl,tree_path,fhash,hash_type,key]
+       return info, tohash, "hash", tree_path, None
+    set_status(info[furl],furl,tree_hash == fhash)
+    return info, tohash, tier, tree_path, tree_hash
+
+
+def load_journal(jfile):
+    ''' Read the journal of an interrupted run or of a shard, return {furl: [furl, tree path, status, tier, hash]}.
+        A last line cut by an interruption is ignored '''
+    done = {}
+    if not opath.isfile(jfile): return done
+    f = open(jfile, 'r')
+    lines = f.read().split("\n")
+    f.close()
+    for line in lines[:-1]:
+        entry = line.split(",")
+        if len(entry) == 5: done[entry[0]] = entry
+    return done
+
+
+def in_shard(furl):
+    ''' Return True if the file url belongs to the shard checked, the same for every run and python process '''
+    return (zlib.crc32(furl) & 0xffffffff) % shard[1] == shard[0] - 1
+
+
+def journal_info(entry):
+    ''' Rebuild the file info from a journal entry, as process_file and check_hash would have set it '''
+    [furl,tree_path,status,tier,fhash] = entry
+    return set_status(get_info(furl.split("/")[-1],tree_path),furl,status == "R")
+
+
+def journal_write(furl, tree_path, status, tier, tree_hash=None):
+    ''' Append the outcome of a file to the journal, as soon as it is known '''
+    journal.write(",".join([furl, tree_path, status, tier, tree_hash or ""]) + "\n")
+    journal.flush()
+
+
+def hash_type(digest):
+    ''' Return the checksum type of a md5 or sha256 hex digest '''
+    if len(digest) == 64: return "sha256"
+    return "md5"
+
+
+def tier_report():
+    ''' Return the number of files whose status was decided by each tier of process_file '''
+    names = [("not_checked", "not checked (ACCESS/CSIRO)"), ("not_on_tree", "not on tree"),
+             ("version", "older version on tree"), ("size", "different size"),
+             ("cache", "cached checksum"), ("quick", "quick check"), ("sample", "sampled from quick check"),
+             ("hash", "checksum calculated")]
+    return "Files classified: " + ", ".join(["%s %d" % (label, tiers.get(name, 0)) for name, label in names])
 
 
 def retrieve_info(query_item):
-    ''' retrieve items of info related to input query combination '''
-    global info
-    # info order is: 0-var, 1-mip, 2-mod, 3-exp, 4-ens, 5-ver, 6-fname, 7-status
-    var, mip = query_item[0].split("_")
-    rows={}
-    # add the items in info with matching var,mip,exp to rows as dictionaries 
-    for item in info.values():
-        if var == item[0] and mip == item[1] and query_item[-1] == item[3]:
-           key = (item[2], item[4], item[5])
-           try:
-              rows[key].append(item[7])
-           except:
-              rows[key] = [item[7]]
-# loop through mod_ens_vers combination counting files to download/update
-    newrows=[]
-    for key in rows.keys():
-        ndown = rows[key].count("D") 
-        status = key[2] + "  " + str(len(rows[key])) + " files, " + str(ndown) + " to update"
-        newrows.append([tuple(key[0:2]), status])
+    ''' retrieve from the index built by add_result the items of info related to input query combination,
+        return a dictionary {(mod,ens): [status of each version]} '''
+    global findex
+    rows = findex.get((query_item[0], query_item[-1]), {})
+# loop through mod_ens_vers combination using the counts of files to download/update
+    newrows={}
+    for key in sorted(rows.keys()):
+        nfiles, ndown = rows[key]
+        status = key[2] + "  " + str(nfiles) + " files, " + str(ndown) + " to update"
+        newrows.setdefault(key[0:2], []).append(status)
     return  newrows
 
 
@@ -248,10 +511,11 @@ def result_matrix(querypub,exp0):
     ''' Build a matrix of the results to output to csv table '''
     global gmatrix
     # querypub contains only published combinations
+    # info is grouped by var_mip/exp and mod/ens/version in findex
     # initialize dictionary of exp/matrices
     gmatrix = {}
     for exp in exp0:
-        # for each var_mip retrieve_info create a dict{var_mip:[[(mod1,ens1), details list][(mod1,ens2), details list],[..]]}
+        # for each var_mip retrieve_info create a dict{var_mip:{(mod1,ens1): details list, (mod1,ens2): details list, ..}}
         # they are added to exp_dict and each key will be column header, (mod1,ens1) will indicate row and details will be cell value
         exp_dict={}
         infoexp = [x for x in querypub if x[-1] == exp]
@@ -263,15 +527,14 @@ def result_matrix(querypub,exp0):
 
 def compare_query(var0,mod0,exp0):
     ''' compare the var_mod_exp combinations found with the requested ones '''
-    global info, opub
-    # for each el. of info: join var_mip, transform to tuple, finally convert modified info to set
-    info_set = set(map(tuple,[["_".join(x[0:2])] + x[2:-4] for x in info.values()]))
+    global found, opub
+    # found is the set of var_mip,model,exp of the files checked
     # create set with all possible combinations of var_mip,model,exp based on constraints
     # if models not specified create a model list based on wget result
-    if len(mod0) < 1: mod0 = [x[2] for x in info.values()]
+    if len(mod0) < 1: mod0 = set([x[1] for x in found])
     comb_query = set(itertools.product(*[var0,mod0,exp0]))
     # the difference between two sets gives combinations not published yet
-    nopub_set = comb_query.difference(info_set)
+    nopub_set = comb_query.difference(found)
     for item in nopub_set:
         opub.write(",".join(item) + "\n")
     # write a matrix to pass results to csv table in suitable format
@@ -284,31 +547,27 @@ def write_table(nopub):
     global gmatrix
     for exp in exp0:
     # length of dictionary gmatrix[exp] is number of var_mip columns
-    # maximum length of list in each dict inside gmatrix[exp] is number of mod/ens rows
+    # each dict inside gmatrix[exp] has the mod/ens rows for the var_mip as keys
         emat = gmatrix[exp]
         klist = emat.keys()
     # check if there are extra variables never published
         evar = list(set( [np[0] for np in nopub if np[0] not in klist if np[-1]==exp ] ))
-    # calculate ncol,nrow keeping into account var never published
-        ncol = len(klist) +2 + len(evar)
-        nrow = max([len(emat[x]) for x in klist]) +1
     # open/create a csv file for each experiment
         try:
            csv = open(exp+".csv","w") 
         except:
            print "Can not open file " + exp + ".csv" 
         csv.write(" model_ensemble/variable," + ",".join(klist+evar) + "\n") 
-      # pre-fill all values with "NP", leave 1 column and 1 row for headers 
-      # write first two columns with all (mod,ens) pairs
-        col1= [emat[var][i][0] for var in klist for i in range(len(emat[var])) ]
-        col1 = list(set(col1))
+      # write first column with all (mod,ens) pairs, sorted
+        col1 = set()
+        for var in klist:
+            col1.update(emat[var].keys())
         col1_sort=sorted(col1)
-      # write first column with mod_ens combinations & save row indexes in dict where keys are (mod,ens) combination
-      #  print col1_sort
+      # fill the values for each var_mip with the status of each version, "NP" if not published
         for modens in col1_sort:
             csv.write(modens[0] + "_" + modens[1]) 
             for var in klist:
-                line = [item[1].replace(", " , " (")   for item in emat[var] if item[0] == modens]
+                line = [item.replace(", " , " (") for item in emat[var].get(modens, [])]
                 if len(line) > 0:
                    csv.write(", " +  " ".join(line) + ")")
                 else:
@@ -318,12 +577,12 @@ def write_table(nopub):
                    csv.write(",NP")
             csv.write("\n")
         csv.close()
-    print "Data written in table "
+    log(1, "Data written in table ")
     return
 
 def main():
     ''' Main program starts here '''
-    global opub, odown, orep, info
+    global opub, outputs, found, findex, nfiles, tiers, journal, deferred
 # somefile is false starting turns to true if at elast one file found
     somefile=False
 # read inputs and assign constraints
@@ -332,53 +591,159 @@ def main():
     frep = outfile + '_replica.csv'
     fpub = outfile + '_not_published.csv'
 # test reading inputs
-    print var0
-    print exp0
-    print mod0
-    print fdown
-    print frep
-    print fpub
-# if one of the output files exists issue a warning an exit
-    if opath.isfile(fdown) or opath.isfile(frep) or opath.isfile(fpub):
+    log(1, var0)
+    log(1, exp0)
+    log(1, mod0)
+    log(1, fdown)
+    log(1, frep)
+    log(1, fpub)
+# if one of the output files exists issue a warning an exit, shards write only their journal
+# an interrupted run leaves partial outputs, with --resume they are written again from the journal
+    if not shard and not resume and (opath.isfile(fdown) or opath.isfile(frep) or opath.isfile(fpub)):
        print "Warning: one of the output files exists, exit to not overwrite!"
        sys.exit() 
-    info={}
-# loop through experiments, 1st create a wget request for exp, then parse_file 
-    for exp in exp0:
-        wgetfile = "wget_" + exp + ".out"
-        result=parse_file(wgetfile,var0,mod0,exp)
-# if found any files matching constraints, process them one by one
-# using multiprocessing Pool to parallelise process_file 
-        if result:
-           async_results = Pool(1).map_async(process_file, result)
-           for dinfo in async_results.get():
-               info.update(dinfo)
-           somefile=True
-        print "Finished checksum for existing files" 
+# only the combinations found and the counts for the table are kept in memory, files are written as they are checked
+    outputs=None
+    found=set()
+    findex={}
+    nfiles=0
+# files to hash are written to a temporary spool file instead of being kept in memory
+    spool=tempfile.TemporaryFile()
+    nhash=0
+    hash_bytes=0
+# number of files decided by each tier of process_file
+    tiers={}
+# the journal of a previous run is continued only with --resume
+    done = {}
+    if merge:
+       for mfile in merge:
+           done.update(load_journal(mfile))
+    else:
+       if opath.isfile(jfile) and not resume:
+          sys.exit("Journal " + jfile + " exists, use --resume to continue that run or remove it")
+       if resume: done = load_journal(jfile)
+       journal = open(jfile, "a")
+# the new entries start on a new line, after a line cut by the interruption
+       if opath.getsize(jfile) > 0:
+          f = open(jfile, "r")
+          f.seek(-1, 2)
+          if f.read(1) != "\n": journal.write("\n")
+          f.close()
+# loop through experiments, 1st read the file list for each exp
+    results = {}
+    with stage("read_files") as st:
+        for exp in exp0:
+            if backend == 'search':
+               results[exp]=load_records("files_" + exp + ".csv",var0,mod0,exp)
+            else:
+               results[exp]=parse_file("wget_" + exp + ".out",var0,mod0,exp)
+            if results[exp]: somefile=True
+            if results[exp] and shard:
+               results[exp] = [r for r in results[exp] if in_shard(r[1])]
+        urls = [r[1] for exp in exp0 if results[exp] for r in results[exp]]
+        st['items'] = len(urls)
 # if it couldn't find any file for any experiment then exit
     if not somefile: 
      sys.exit("No files found for any of the experiments, exiting!") 
+# open replica and download output files and write header, a shard doesn't write outputs, 
+# they are written by --merge from the journals of all the shards
+# when resuming the outputs are truncated and the files in the journal are written first
+    if not shard:
+       odown=open(fdown, "w")
+       odown.write("var, mip_table, model, experiment, ensemble, version, file url\n")
+       orep=open(frep, "w")
+       orep.write("var, mip_table, model, experiment, ensemble, version, filepath\n")
+       outputs = {"R" : orep, "D" : odown}
+# quick checked files accepted without sampling are listed to be fully hashed later
+    deferred=None
+    if deferfile and not merge: deferred=open(deferfile, "a")
+# files already in the journal are not checked again, entries for files no more in the file lists are ignored
+    for furl in urls:
+        if furl in done:
+           add_result(journal_info(done[furl]))
+           tiers[done[furl][3]] = tiers.get(done[furl][3], 0) + 1
+    if resume: log(1, "Resuming from " + jfile + ": %d files already checked" % nfiles)
+    todo = [furl for furl in urls if furl not in done]
+    if merge:
+       log(1, "Merged %d files from %d journals" % (nfiles, len(merge)))
+       if todo: print "Warning: %d files are not in the journals and are not included in the outputs" % len(todo)
+       todo = []
+# build the index of the files on tree, before starting the workers so they all share it
+    with stage("tree_index") as st:
+        if not todo:
+           pass
+        elif tree_index == 'listing':
+           try:
+              st['items'] = CMIP5_tree.build_from_listing(todo, listfile)
+           except ValueError as e:
+              sys.exit(str(e) + ", pass the tree root of the listing with --tree or use --tree-index scan")
+           log(1, "Indexed %d files from %s" % (st['items'], listfile))
+        elif tree_index == 'scan':
+           st['items'] = CMIP5_tree.build_from_scan(todo)
+           log(1, "Indexed %d files scanning the tree directories" % st['items'])
+# one pool of worker processes is used for all the experiments
+    with stage("classify") as st:
+        pool = Pool(nworkers)
+        for exp in exp0:
+            result=[r for r in results[exp] or [] if r[1] not in done and not merge]
+# if found any files matching constraints, process them one by one
+# using multiprocessing Pool to parallelise process_file, results are collected as soon as they are ready
+            if result:
+               chunk = chunksize
+               if not chunk: chunk = max(1, min(100, len(result) // (4*nworkers)))
+               for dinfo,dhash,tier,tree_path,tree_hash in pool.imap_unordered(process_file, result, chunk):
+                   [(furl, finfo)] = dinfo.items()
+                   tiers[tier] = tiers.get(tier, 0) + 1
+                   if dhash:
+                      hash_bytes += spool_write(spool, dhash, tier, tree_hash)
+                      nhash += 1
+                   else:
+                      add_result(finfo)
+                      journal_write(furl, tree_path, finfo[-1], tier, tree_hash)
+# workers only read the cache, the use of the cached checksums is written here in batches
+                      if tier in ["cache", "quick"]: cache_touch(tree_path, hash_type(tree_hash))
+                      if tier == "quick" and deferred and finfo[-1] == "R":
+                         deferred.write(",".join([tree_path, hash_type(tree_hash), tree_hash]) + "\n")
+                   progress("classify", nfiles + nhash, len(urls))
+        pool.close()
+        pool.join()
+        st['items'] = nfiles + nhash
+# calculate hash of files that exist on tree but are not in the cache
+    with stage("hash") as st:
+        check_hash(spool, hash_bytes)
+        st['items'] = nhash
+    spool.close()
+    if not merge: journal.close()
+    if deferred: deferred.close()
+    log(1, "Finished checksum for existing files")
+    log(1, tier_report())
+# remove least recently used entries if checksum cache is bigger than its maximum size
+    evict_cache()
+    if shard:
+       log(1, "Finished shard %d of %d, results in %s" % (shard[0], shard[1], jfile))
+       CMIP5_metrics.summary(files=nfiles, files_hashed=hash_stats['files'], bytes_hashed=hash_stats['bytes'],
+                             hash_errors=hash_stats['errors'], **dict(("tier_" + k, v) for k, v in tiers.items()))
+       return
+    with stage("write_outputs"):
 # open not published file
-    opub=open(fpub, "w")
-    opub.write("var_mip-table, model, experiment\n")
+        opub=open(fpub, "w")
+        opub.write("var_mip-table, model, experiment\n")
 # build all requested combinations and compare to files found
-    nopub_set = compare_query(var0,mod0,exp0)
-# write replica and download output files
-# open output files and write header
-    odown=open(fdown, "w")
-    odown.write("var, mip_table, model, experiment, ensemble, version, file url\n")
-    orep=open(frep, "w")
-    orep.write("var, mip_table, model, experiment, ensemble, version, filepath\n")
-    write_file()
+        nopub_set = compare_query(var0,mod0,exp0)
 # close all the output files
-    odown.close()
-    orep.close()
-    opub.close()
-    print "Finished to write output files" 
+        odown.close()
+        orep.close()
+        opub.close()
+    log(1, "Finished to write output files")
 # if table option create/open spreadsheet
 # if table option write summary table in csv file
     if table: 
-       write_table(nopub_set)
+       with stage("table"):
+           write_table(nopub_set)
+# files checked on tree are the ones not decided before getting their size
+    CMIP5_metrics.summary(files=nfiles, files_stat=sum([tiers.get(t, 0) for t in ["size", "cache", "quick", "sample", "hash"]]),
+                          files_hashed=hash_stats['files'], bytes_hashed=hash_stats['bytes'],
+                          hash_errors=hash_stats['errors'], **dict(("tier_" + k, v) for k, v in tiers.items()))
 
 # check python version and then call main()
 if sys.version_info < ( 2, 7):
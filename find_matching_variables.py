@@ -7,11 +7,19 @@
 #     if not specified assumed the input file is CMIP5_files_in_tree.csv 
 # It creates two csv file called complete_ensemble.csv that lists MIP code, model, ensemble, (version) for each ensemble that has all the requested variables
 # The other file not_complete_ensemble.csv lists the remaining ensembles that have some but not all the variables
+# The input is read once: each var_cmip-table requested is given a bit and each model/experiment/ensemble gets an integer
+# with the bits of the variables it has, so checking a set of variables is a bitwise AND.
+# Many sets of variables can be checked at once listing them in a file passed with -s/--sets, one set for each line
+# as "name: var1_cmip var2_cmip ...", the name is optional. The outputs then have the set name as first column.
+# Instead of the csv file the database created by CMIP5_replica_db.py can be used as input with -d/--database,
+# only the ensembles still on the tree (status current) are considered.
+# --metrics FILE appends the time taken and the number of ensembles read and matched as json lines.
 #
 # Example of how to run on raijin.nci.org.au
 #
 #    module load python/2.7.3  (default on raijin)
 #    python find_matching_variables.py  -v ua_Amon -v tos_Omon -v tas_Amon output.csv  
+#    python find_matching_variables.py  -s variable_sets.txt -d CMIP5_database.db
 #
 # Notes concerning the above example: 
 #  - the variable argument is passed as variable-name_cmip-table, this avoids confusion if looking for variables from different cmip tables
@@ -24,6 +32,10 @@
 
 import os, datetime, glob, re
 import sys, getopt   # these are needed to accept external arguments
+import sqlite3
+from CMIP5_parser import csv_details
+import CMIP5_metrics
+from CMIP5_metrics import stage
 
 ## helper functions
 
@@ -33,6 +45,12 @@ def help():
     print '''\n           
  Takes the following arguments:\n           
    -v / --variable    combination of CMIP5 variable & cmip_table Ex. tas_Amon\n
+   -s / --sets        file listing many sets of variables, one set for each line\n
+                      as "name: var1_cmip var2_cmip ...", name is optional\n
+   -i / --input       input csv file, default CMIP5_files_in_tree.csv\n
+   -d / --database    read the ensembles from the database created by CMIP5_replica_db.py\n
+                      instead of the csv file\n
+   --metrics          append the run metrics as json lines to this file\n
    -h / --help        display this message and exit \n           
    output_file        this should always come last, arguments passed after this\n
                       will be ignored\n
@@ -43,26 +61,94 @@ def help():
 
 
 def file_details(file):
-    ''' Split the filename in variable, MIP code, model, experiment, ensemble (period is excluded) ''' 
-    bits = file.split(',')
+    ''' Split the csv line in var_cmip-table and (model, experiment, ensemble) ''' 
+    bits = csv_details(file)
     varcmip = '_'.join(bits[0:2]) 
-    modelrun = '_'.join(bits[2:5]) 
+    modelrun = tuple(bits[2:5]) 
     return (varcmip,modelrun)
 
 
+def read_csv(infile):
+    ''' Yield (var_cmip-table, model run) for each line of the search_CMIP5_replica.py output, skipping the header '''
+    inf = open(infile, 'r')
+    inf.readline()
+    for line in inf:
+        yield file_details(line.rstrip('\n'))
+    inf.close()
+
+
+def read_db(dbfile):
+    ''' Yield (var_cmip-table, model run) for each ensemble in the CMIP5_replica_db.py database still on the tree '''
+    conn = sqlite3.connect(dbfile)
+    sql = "SELECT DISTINCT variable, mip, model, experiment, ensemble FROM cmip5"
+# databases created by older versions have no status field
+    if 'status' in [x[1] for x in conn.execute("PRAGMA table_info(cmip5)")]:
+       sql += " WHERE status='current'"
+    for row in conn.execute(sql):
+        yield (row[0] + '_' + row[1], tuple(row[2:5]))
+    conn.close()
+
+
+def read_sets(setfile):
+    ''' Read the sets of variables from a file, return a list of (name, list of var_cmip-table) '''
+    sets = []
+    for line in open(setfile, 'r'):
+        line = line.split('#')[0].strip()
+        if not line: continue
+        name = 'set' + str(len(sets) + 1)
+        if ':' in line:
+           name, line = [x.strip() for x in line.split(':', 1)]
+        sets.append((name, line.replace(',', ' ').split()))
+    return sets
+
+
+def bit_positions(sets):
+    ''' Give a bit to each var_cmip-table in the sets, return {var_cmip-table: bit value} '''
+    bits = {}
+    for name, varlist in sets:
+        for var in varlist:
+            if var not in bits: bits[var] = 1 << len(bits)
+    return bits
+
+
+def build_masks(records, bits):
+    ''' Build in one pass {model run: bitmask of the requested variables it has}, 
+        only model runs with at least one of the variables are included '''
+    masks = {}
+    for varcmip, run in records:
+        bit = bits.get(varcmip)
+        if bit: masks[run] = masks.get(run, 0) | bit
+    return masks
+
+
+def match_sets(masks, sets, bits):
+    ''' Yield (set name, model run, True if complete or False if only some variables are present)
+        for each set and each model run with at least one of its variables '''
+    for name, varlist in sets:
+        setmask = 0
+        for var in varlist:
+            setmask |= bits[var]
+        for run in sorted(masks):
+            found = masks[run] & setmask
+            if found: yield name, run, found == setmask
+
+
 # Main program starts here
 #set up input file and selected variable (or group of variables) and experiment
 #infile is updated every Monday and contains a list of all files replicated on raijin 
 infile = 'CMIP5_files_in_tree.csv'
+dbfile = None
+setfile = None
+metrics = None
 # assign default values to constraints
 var0 = []
 outfile = 'complete_ensembles.csv'
 outfile2 = 'not_complete_ensembles.csv'
 
 # assign constraints from arguments list
-letters = 'v:h' # the : means an argument needs to be passed after the letter
+letters = 'v:s:i:d:h' # the : means an argument needs to be passed after the letter
 #the = means that a value is expected after the keyword
-keywords = ['variable=', 'help'] 
+keywords = ['variable=', 'sets=', 'input=', 'database=', 'metrics=', 'help'] 
 opts, extraparams = getopt.getopt(sys.argv[1:],letters,keywords) 
 # starts at the second element of argv since the first one is the script name
 # extraparams are extra arguments passed after all option/keywords are assigned
@@ -71,64 +157,65 @@ opts, extraparams = getopt.getopt(sys.argv[1:],letters,keywords)
 for o,p in opts:
   if o in ['-v','--variable']:
      var0.append(p)
+  elif o in ['-s','--sets']:
+     setfile = p
+  elif o in ['-i','--input']:
+     infile = p
+  elif o in ['-d','--database']:
+     dbfile = p
+  elif o in ['--metrics']:
+     metrics = p
   elif o in ['-h','--help']:
      help() 
 for p in extraparams:
     outfile = p 
     outfile2 = "not_" + p  
  
-print "Looking for following variable/cmip_table combinations:\n", var0 
+CMIP5_metrics.setup(metrics)
+# the variables passed with -v are one set, the sets in the file are added to it
+sets = []
+if var0: sets.append(('variables', var0))
+if setfile: sets.extend(read_sets(setfile))
+if not sets:
+   sys.exit("No variables given, use -v or -s")
+print "Looking for following variable/cmip_table combinations:\n", "\n".join([n + ": " + " ".join(v) for n,v in sets])
 print 'Output file for model runs including all variables: ' + outfile
 print 'Output file for incomplete model runs: ' + outfile2
     
-### open input file and output files 
-inf = open(infile, 'r')
+### open input and output files 
+if dbfile:
+   records = read_db(dbfile)
+else:
+   records = read_csv(infile)
 outf = open(outfile, 'w')
 outf2 = open(outfile2, 'w')
+# the set name is added as first column only if more than one set is checked
+multi = len(sets) > 1
 line1 = 'model,experiment,ensemble\n'
+if multi: line1 = 'set,' + line1
 outf.write(line1)
 outf2.write(line1)
 
-
-# read all the file paths line by line
-lines = inf.readlines()
-
-# out_lines is a set of unique lines to add as output, 1 line for each ensemble
-out_lines_true = set() 
-out_lines_false = set() 
-model_run = set()
-file_set = set() 
-# loops through all the files
-for file in lines[1:]:
-    file.replace('\n','')
-# call file_details to retrieve var_cmip and model_run (model/exp/ensemble) for each file 
-    details = file_details(file)
-    file_set.add(details) 
-    model_run.add(details[1])
-
-for run in list(model_run):
-    for var in var0:
-       comb = ((var,run))
-       if comb in file_set: 
-          output = True
-       else:
-          output = False
-          break
-    if output:
-       out_lines_true.add(run.replace("_",","))
-    else:
-       out_lines_false.add(run.replace("_",","))
-       
-# write to output file
-for sline in out_lines_true:
-    outf.write(sline+"\n")
-outf.close
-for sline in out_lines_false:
-    outf2.write(sline+"\n")
-outf2.close
-
-# close input file
-inf.close
-
-    
-
+# read the input once building a bitmask of the variables found for each model/experiment/ensemble
+bits = bit_positions(sets)
+with stage('read') as st:
+    masks = build_masks(records, bits)
+    st['items'] = len(masks)
+
+# write to output files, complete runs to the first one and runs with only some of the variables to the second
+ncomplete = 0
+npartial = 0
+with stage('match') as st:
+    for name, run, complete in match_sets(masks, sets, bits):
+        sline = ",".join(run)
+        if multi: sline = name + "," + sline
+        if complete:
+           outf.write(sline+"\n")
+           ncomplete += 1
+        else:
+           outf2.write(sline+"\n")
+           npartial += 1
+    st['items'] = len(masks) * len(sets)
+outf.close()
+outf2.close()
+CMIP5_metrics.summary(sets=len(sets), ensembles=len(masks), complete=ncomplete, partial=npartial)
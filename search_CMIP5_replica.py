@@ -15,6 +15,19 @@
 #  - you can pass a different name for the output file, just by listing as 
 #    last argument (output.csv in the example); 
 #  - all arguments are optional; 
+#  - -j/--nproc N scans the file list with N processes, each one reading a different part of the file;
+#  - -i/--input FILE reads a different file list, with the same format;
+#  - --metrics FILE appends the time taken and the number of lines scanned and matched as json lines,
+#    --verbose 0 prints only warnings;
+#  - -b/--batch FILE answers many named constraint sets with one scan of the file list, each set is written
+#    to its own csv file, the other constraints are ignored. The file has a section for each set, for example:
+#      [tas_historical]
+#      variable = tas tasmax
+#      experiment = historical
+#      frequency = mon
+#      output = tas_historical.csv
+#    model and mip_table can be used too, all options are optional, output defaults to <set name>.csv;
+#  - -s/--server URL gets the matching ensembles from a CMIP5_daemon.py service instead of scanning the file list;
 #  - failing to set any constraint will result in the entire dataset being 
 #    selected.  
 #
@@ -28,6 +41,11 @@
 
 import os, datetime, glob, re
 import sys, getopt   # these are needed to accept external arguments
+from CMIP5_parser import scan_file, compile_constraints, parse_report, frequency_tables, parse_stats
+from CMIP5_parser import read_batch, union_constraints, compile_router, route, VAR, MIP, MODEL, EXP
+from CMIP5_daemon import query_server
+import CMIP5_metrics
+from CMIP5_metrics import stage
 
 ## helper functions
 
@@ -41,6 +59,13 @@ def help():
    -e / -- experiment CMIP5 experiment ex historical\n           
    -t / --mip_table   CMIP5 MIP table   ex Amon\n           
    -f / --frequency   valid values are: day, mon, yr, 3hr, 6hr, subhr, fx, clim\n           
+   -j / --nproc       number of processes used to scan the file list, default 1\n
+   --metrics          append the run metrics as json lines to this file\n
+   --verbose          0 prints only warnings, default 1 also prints progress\n
+   -b / --batch       file of named constraint sets, all answered with one scan of the file list\n
+                      and written to separate csv files\n
+   -i / --input       file list to read, default is the weekly list of files on the tree\n
+   -s / --server      url of a CMIP5_daemon.py service to query instead of scanning the file list\n
    -h / --help        display this message and exit \n           
    output_file        this should always come last, arguments passed after this\n
                       will be ignored\n
@@ -58,60 +83,46 @@ def help():
     sys.exit()
 
 
-def file_details(fname):
-    ''' Split the filename in variable, MIP code, model, experiment, ensemble (period is excluded) ''' 
-    namebits = fname.split('_')
-    if len(namebits) >= 5:
-      details = namebits[0:5] 
-    else:
-      details = []
-    return details
-
-
-def match_constraints(details,cons):
-    ''' If the variable and experiment match the constraints add file to list '''
-    con_num = len(cons)
-    i = 0
-    details_set = set(details)
-    add_file = True
-    while i <= con_num -1:
-       if len(cons[i]) > 0:
-         if list(details_set.intersection(cons[i])) == []:
-            add_file = False
-            break 
-       i +=1
-    return add_file
-    
-
-def find_string(bits,string):
-    ''' Returns matching string if found in directory structure '''
-    dummy = filter(lambda el: re.findall( string, el), bits)
-    if len(dummy) == 0:
-        return 'not_specified'
-    else:
-        return dummy[0]
-
-
 def assign_frequency(frq):
     ''' Append the cmip5 mip tables corresponding to the input frequency to the listmip0 ''' 
     global mip0
-    if frq == 'day':
-       mip0 = mip0 + ['day', 'cfDay', 'dayExtras']
-    elif frq == 'mon':
-       mip0 = mip0 + ['Omon', 'OmonExtras', 'Amon', 'AmonExtras', 'Lmon', 
-                 'LmonExtras', 'OImon', 'LImon', 'cfMon', 'aero', 'cfOff']
-    elif frq == '3hr':
-       mip0 = mip0 + ['3hr', '3hrLev', 'cf3hr', 'cfSites']
-    elif frq == '6hr':
-       mip0 = mip0 + ['6hr', '6hrPlev', '6hrLev'] 
-    elif frq == 'monClim':
-       mip0 = mip0 + ['Oclim', 'Lclim', 'Aclim', 'LIclim'] 
-    elif frq == 'yr':
-       mip0 = mip0 + ['Oyr', 'OyrExtras'] 
-    elif frq == 'fx':
-       mip0 = mip0 + ['fx'] 
-    elif frq == 'subhr':
-       mip0 = mip0 + ['cfSites']
+    mip0 = mip0 + frequency_tables.get(frq, [])
+
+
+def run_batch(batchfile):
+    ''' Answer all the constraint sets of the batch file with one scan of the file list, writing each to its own csv file '''
+    queries = read_batch(batchfile)
+    if not queries:
+       sys.exit("No constraint sets found in " + batchfile)
+    outs = []
+    fields = {VAR: 'variable', MIP: 'mip_table', MODEL: 'model', EXP: 'experiment'}
+    for name, out, cons in queries:
+        print name + ': ' + (', '.join([fields[pos] + ' ' + ' '.join(sorted(v)) for pos, v in cons]) or 'no constraints') + ' -> ' + out
+        outf = open(out, 'w')
+        outf.write('variable,mip_table,model,experiment,ensemble,version,path\n')
+        outs.append((outf, set()))
+# the file list is scanned once with the union of the constraints, then each record is routed to the matching sets
+    router = compile_router([q[2] for q in queries])
+    with stage('scan') as st:
+        for rec in scan_file(infile, union_constraints([q[2] for q in queries]), nproc):
+            mask = route(rec, router)
+            i = 0
+            while mask:
+                if mask & 1:
+                   outf, out_lines = outs[i]
+                   sline = ','.join(rec)
+                   if sline not in out_lines:
+                      out_lines.add(sline)
+                      outf.write(sline+"\n")
+                mask >>= 1
+                i += 1
+        st['items'] = parse_stats['lines']
+    for (name, out, cons), (outf, out_lines) in zip(queries, outs):
+        outf.close()
+        print "%s: %d ensembles" % (name, len(out_lines))
+    print parse_report()
+    CMIP5_metrics.summary(lines=parse_stats['lines'], matched=parse_stats['matched'], queries=len(queries),
+                          ensembles=sum([len(o[1]) for o in outs]))
 
 # Main program starts here
 #set up input file and selected variable (or group of variables) and experiment
@@ -123,11 +134,16 @@ exp0 = []
 mod0 = []
 mip0 = []
 outfile = 'CMIP5_files_in_tree.csv'
+nproc = 1
+server = None
+batchfile = None
+metrics = None
+verbose = 1
 
 # assign constraints from arguments list
-letters = 'v:m:e:t:f:h' # the : means an argument needs to be passed after the letter
+letters = 'v:m:e:t:f:j:s:i:b:h' # the : means an argument needs to be passed after the letter
 #the = means that a value is expected after the keyword
-keywords = ['variable=', 'model=', 'experiment=', 'mip_table=', 'frequency=', 'help'] 
+keywords = ['variable=', 'model=', 'experiment=', 'mip_table=', 'frequency=', 'nproc=', 'server=', 'input=', 'metrics=', 'verbose=', 'batch=', 'help'] 
 opts, extraparams = getopt.getopt(sys.argv[1:],letters,keywords) 
 # starts at the second element of argv since the first one is the script name
 # extraparams are extra arguments passed after all option/keywords are assigned
@@ -145,55 +161,64 @@ for o,p in opts:
   elif o in ['-f','--frequency']:
      frq = p
      assign_frequency(frq) 
+  elif o in ['-j','--nproc']:
+     nproc = int(p)
+  elif o in ['-s','--server']:
+     server = p
+  elif o in ['-i','--input']:
+     infile = p
+  elif o in ['-b','--batch']:
+     batchfile = p
+  elif o in ['--metrics']:
+     metrics = p
+  elif o in ['--verbose']:
+     verbose = int(p)
   elif o in ['-h','--help']:
      help() 
 for p in extraparams:
     outfile = p 
  
+CMIP5_metrics.setup(metrics, verbose)
+if batchfile:
+   run_batch(batchfile)
+   sys.exit()
 # join constraints in a list
 constraints = [var0, mod0, exp0, mip0]
 for i in range(len(constraints)):
     print keywords[i] + ":  " + str(constraints[i])
+constraints = compile_constraints(var0, mod0, exp0, mip0)
 print 'Output file: ' + outfile
     
 ### needs to include something to take care of all decadals
-inf = open(infile, 'r')
 outf = open(outfile, 'w')
 line1 = 'variable,mip_table,model,experiment,ensemble,version,path\n'
 outf.write(line1)
 
 
-# read all the file paths line by line
-lines = inf.readlines()
-
-# define a valid pattern for version
-version = '[a-z]*201[0-9][0-1][0-9][0-3][0-9]'
-# out_lines is a set of unique lines to add as output, 1 line for each ensemble
+# out_lines is a set of unique lines already written, 1 line for each ensemble
+# only matching ensembles are kept in memory, the file list is read lazily
+# if nproc > 1 the file list is split in shards scanned by nproc processes
+# if a server is given the ensembles are requested from it and the file list is scanned only if it can't be reached
+records = None
+if server:
+   try:
+       records = query_server(server, var0, mod0, exp0, mip0)
+       print 'Query answered by ' + server
+   except IOError as e:
+       print 'Warning: could not query ' + server + ' (' + str(e) + '), scanning the file list'
+scanned = records is None
+if scanned:
+   records = scan_file(infile, constraints, nproc)
 out_lines = set()
-# loops through all the files
-for filepath in lines[:]:
-    filepath.replace('\n','')
-    bits = filepath.split('/')
-    fname = (bits[-1])[:-1]
-# call file_details to retrieve experiment, variable, model etc. from filename 
-    details = file_details(fname)
-# make sure details list isn't empty 
-    if len(details) > 0:
-# if file details satisfies the constraint file added to output 
-      if match_constraints(details,constraints):
-         vers = find_string(bits[:-1], version)
-         newpath = '/'.join(bits[:-1])
-         slist = details + [vers, newpath]
-         sline = ','.join(slist)
-         out_lines.add(sline)
-    
-# write to output file
-for sline in out_lines:
-    outf.write(sline+"\n")
-
-# close input and output file
-inf.close
-outf.close
-
-    
-
+with stage('scan') as st:
+    for slist in records:
+        sline = ','.join(slist)
+        if sline not in out_lines:
+           out_lines.add(sline)
+           outf.write(sline+"\n")
+    st['items'] = parse_stats['lines']
+if scanned: print parse_report()
+CMIP5_metrics.summary(lines=parse_stats['lines'], matched=parse_stats['matched'], ensembles=len(out_lines))
+
+# close output file
+outf.close()
@@ -0,0 +1,46 @@
+# Tests of the checksum cache of CMIP5_checksum.py
+#
+# Run from the repository directory with:
+#
+#    python -m unittest discover tests
+
+import os, sys, shutil, tempfile, unittest
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+import CMIP5_checksum
+from CMIP5_checksum import open_cache, file_key, hash_file, cache_put, cache_flush, cache_quick
+
+
+class QuickCheckTest(unittest.TestCase):
+    ''' Quick check of a file whose checksum is in the cache with its fingerprint '''
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = CMIP5_checksum.cache_file
+        open_cache(os.path.join(self.dir, 'cache.db'))
+        self.path = os.path.join(self.dir, 'tas.nc')
+        f = open(self.path, 'wb')
+        f.write('a' * 1000)
+        f.close()
+        self.key = file_key(self.path)
+        digest, nbytes, fp = hash_file(self.path, 'md5', fprint=True)
+        cache_put(self.path, 'md5', self.key, digest, fp)
+        cache_flush()
+        self.digest = digest
+
+    def tearDown(self):
+        open_cache(self.cache)
+        shutil.rmtree(self.dir)
+
+    def test_same_fingerprint(self):
+        self.assertEqual(cache_quick(self.path, 'md5', self.key), self.digest)
+
+    def test_removed_file(self):
+        ''' A file removed after its key was read is left to be hashed '''
+        os.remove(self.path)
+        self.assertEqual(cache_quick(self.path, 'md5', self.key), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
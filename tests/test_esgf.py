@@ -0,0 +1,153 @@
+# Tests of the ESGF search client CMIP5_esgf.py, run against a stub esg-search service on localhost
+#
+# Run from the repository directory with:
+#
+#    python -m unittest discover tests
+
+import os, sys, time, threading, unittest, urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+import CMIP5_esgf
+from CMIP5_esgf import ESGFError, node_url, nodes, fetch_wget, fetch_all, file_lines, query_params, files_end
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    ''' esg-search stub: files is the number of files of each experiment, fail the list of error statuses
+        returned to the next requests, short the number of files after which wget pages are empty '''
+    daemon_threads = True
+
+    def __init__(self, files):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.files = files
+        self.fail = []
+        self.short = None
+        self.delay = 0
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    ''' Answer the count (search with limit=0) and wget requests of fetch_wget, with keep-alive connections '''
+    protocol_version = 'HTTP/1.1'
+# idle keep-alive connections are closed, so the server threads end with the test
+    timeout = 0.5
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse.urlsplit(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        with server.lock:
+            server.requests.append((url.path, query))
+            status = server.fail.pop(0) if server.fail else 200
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(server.delay)
+            if status != 200:
+               return self.reply(status, 'error')
+            nfiles = server.files[query['experiment']]
+            if url.path.endswith('/search'):
+               return self.reply(200, '{"response": {"numFound": %d, "docs": []}}' % nfiles)
+            offset = int(query['offset'])
+            end = min(offset + int(query['limit']), nfiles)
+            if server.short is not None: end = min(end, server.short)
+            lines = ["'f%d_%s.nc' 'http://node/%s/f%d.nc' 'MD5' '%032d'\n" % (i, query['experiment'],
+                     query['experiment'], i, i) for i in range(offset, end)]
+            self.reply(200, '#!/bin/bash\ndownload_files="$(cat <<' + files_end + '\n' + ''.join(lines) +
+                       files_end + '\n)"\n')
+        finally:
+            with server.lock:
+                server.active -= 1
+
+
+class NodeUrlTest(unittest.TestCase):
+    ''' Resolve node names and urls to the esg-search url '''
+
+    def test_known_node(self):
+        self.assertEqual(node_url('pcmdi'), nodes['pcmdi'])
+
+    def test_url(self):
+        self.assertEqual(node_url('http://localhost:8000/esg-search'), 'http://localhost:8000/esg-search/')
+
+    def test_unknown_node(self):
+        ''' An unknown name raises ESGFError listing the known nodes '''
+        with self.assertRaises(ESGFError) as cm:
+            node_url('llnl')
+        self.assertIn('dkrz, pcmdi', str(cm.exception))
+
+
+class FetchWgetTest(unittest.TestCase):
+    ''' Fetch wget scripts from a stub server for the historical (25 files) and rcp45 (12 files) experiments '''
+
+    def setUp(self):
+        self.server = StubServer({'historical': 25, 'rcp45': 12})
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base = node_url('http://127.0.0.1:%d/esg-search' % self.server.server_address[1])
+        self.backoff = CMIP5_esgf.backoff
+        CMIP5_esgf.backoff = 0
+
+    def tearDown(self):
+        CMIP5_esgf.backoff = self.backoff
+        for conn in getattr(CMIP5_esgf._local, 'conns', {}).values(): conn.close()
+        CMIP5_esgf._local.conns = {}
+        self.server.shutdown()
+        self.server.server_close()
+
+    def wget_offsets(self):
+        return [int(q['offset']) for path, q in self.server.requests if path.endswith('/wget')]
+
+    def test_offset_paging(self):
+        ''' All the files are in one script, requested in pages of limit files '''
+        script = fetch_wget(self.base, query_params('historical', [], ['tas'], ['Amon']), limit=10)
+        lines = file_lines(script)
+        self.assertEqual(len(lines), 25)
+        self.assertEqual(lines[0].split()[0], "'f0_historical.nc'")
+        self.assertEqual(lines[-1].split()[0], "'f24_historical.nc'")
+        self.assertEqual(script.count(files_end), 2)
+        self.assertEqual(self.wget_offsets(), [0, 10, 20])
+
+    def test_retry(self):
+        ''' Requests that fail with 503 or 429 are retried '''
+        self.server.fail = [503, 429]
+        script = fetch_wget(self.base, query_params('rcp45', [], ['tas'], ['Amon']), limit=10)
+        self.assertEqual(len(file_lines(script)), 12)
+        self.assertEqual(len(self.server.requests), 5)
+
+    def test_client_error(self):
+        ''' A 4xx response other than 429 is not retried '''
+        self.server.fail = [404]
+        self.assertRaises(ESGFError, fetch_wget, self.base, query_params('rcp45', [], ['tas'], ['Amon']))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_short_pages(self):
+        ''' A node that stops sending files before the count raises ESGFError instead of losing them '''
+        self.server.short = 15
+        self.assertRaises(ESGFError, fetch_wget, self.base, query_params('historical', [], ['tas'], ['Amon']), 10)
+
+    def test_concurrent_experiments(self):
+        ''' The queries of several experiments run at the same time, the results are in the order of the tasks '''
+        self.server.delay = 0.2
+        tasks = [(self.base, query_params(exp, [], ['tas'], ['Amon'])) for exp in ['historical', 'rcp45']]
+        scripts = fetch_all(tasks, 2)
+        self.assertEqual([len(file_lines(s)) for s in scripts], [25, 12])
+        self.assertEqual(self.server.max_active, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# Tests of fetch_step2.py on a small replica tree built in a temporary directory
+#
+# Run from the repository directory with:
+#
+#    python -m unittest discover tests
+
+import os, sys, shutil, tempfile, hashlib, subprocess, unittest
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+from CMIP5_esgf import write_records
+
+server = 'aims3.llnl.gov/thredds/fileServer/cmip5_data/cmip5/output1/NCAR/CCSM4/historical/mon/atmos/Amon/r1i1p1/'
+
+
+class Step2Test(unittest.TestCase):
+    ''' Run fetch_step2.py for tas_Amon historical files, some of them on the tree '''
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.tree = os.path.join(self.dir, 'tree')
+        os.mkdir(self.tree)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def add_file(self, year, data, version='v20120101'):
+        ''' Put a file on the tree, return its url and path '''
+        fname = 'tas_Amon_CCSM4_historical_r1i1p1_%d01-%d12.nc' % (year, year + 9)
+        furl = server + version + '/tas/' + fname
+        path = os.path.join(self.tree, furl)
+        if not os.path.isdir(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        return furl, path
+
+    def write_wget(self, files):
+        ''' Write wget_historical.out listing the published files as (url, data) '''
+        f = open(os.path.join(self.dir, 'wget_historical.out'), 'w')
+        f.write('download_files="$(cat <<EOF--dataset.file.url.chksum_type.chksum\n')
+        for furl, data in files:
+            f.write("'%s' 'http://%s' 'MD5' '%s'\n" % (furl.rsplit('/', 1)[-1], furl, hashlib.md5(data).hexdigest()))
+        f.write('EOF--dataset.file.url.chksum_type.chksum\n)"\n')
+        f.close()
+
+    def run_step2(self, *args):
+        ''' Run fetch_step2.py in the temporary directory, return its exit code and output '''
+        cmd = [sys.executable, os.path.join(repo, 'fetch_step2.py'), '-v', 'tas_Amon', '-e', 'historical', '-o', 'out',
+               '--tree', self.tree, '--no-cache', '-w', '1'] + list(args)
+        proc = subprocess.Popen(cmd, cwd=self.dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        return proc.returncode, output
+
+    def read_output(self, kind):
+        ''' Return the last column of the rows of out_<kind>.csv '''
+        f = open(os.path.join(self.dir, 'out_' + kind + '.csv'))
+        rows = [line.rstrip('\n').split(',')[-1] for line in f][1:]
+        f.close()
+        return sorted(rows)
+
+    def test_removed_listed_file(self):
+        ''' A file in the listing but removed from the tree is to download '''
+        url1, path1 = self.add_file(1850, 'a' * 100)
+        url2, path2 = self.add_file(1860, 'b' * 100)
+        self.write_wget([(url1, 'a' * 100), (url2, 'b' * 100)])
+        listing = os.path.join(self.dir, 'listing.txt')
+        f = open(listing, 'w')
+        f.write(path1 + '\n' + path2 + '\n')
+        f.close()
+        os.remove(path2)
+        code, output = self.run_step2('--tree-index', 'listing', '--listing', listing)
+        self.assertEqual(code, 0, output)
+        self.assertEqual(self.read_output('replica'), [path1])
+        self.assertEqual(self.read_output('to_download'), ['http://' + url2])
+
+    def test_listing_other_tree(self):
+        ''' A listing of a tree with a different root stops the run instead of reporting all the files not on tree '''
+        url1, path1 = self.add_file(1850, 'a' * 100)
+        self.write_wget([(url1, 'a' * 100)])
+        listing = os.path.join(self.dir, 'listing.txt')
+        f = open(listing, 'w')
+        f.write('/g/data/ua6/tree/' + url1 + '\n')
+        f.close()
+        code, output = self.run_step2('--tree-index', 'listing', '--listing', listing)
+        self.assertNotEqual(code, 0)
+        self.assertIn('not under the tree root', output)
+
+    def test_listing_linked_tree(self):
+        ''' The tree root can be passed through a symbolic link to the directory of the listing paths '''
+        url1, path1 = self.add_file(1850, 'a' * 100)
+        self.write_wget([(url1, 'a' * 100)])
+        listing = os.path.join(self.dir, 'listing.txt')
+        f = open(listing, 'w')
+        f.write(path1 + '\n')
+        f.close()
+        link = os.path.join(self.dir, 'link')
+        os.symlink(self.tree, link)
+        code, output = self.run_step2('--tree-index', 'listing', '--listing', listing, '--tree', link)
+        self.assertEqual(code, 0, output)
+        self.assertEqual(self.read_output('replica'), [os.path.join(link, url1)])
+
+    def test_newer_published_version(self):
+        ''' A file from the search records with a newer dataset version than the tree is to download unread '''
+        data = 'a' * 100
+        url1, path1 = self.add_file(1850, data)
+        url2, path2 = self.add_file(1860, data)
+        md5 = hashlib.md5(data).hexdigest()
+        write_records(os.path.join(self.dir, 'files_historical.csv'),
+                      [[url1.rsplit('/', 1)[-1], 'http://' + url1, md5, 'MD5', '100', 'v20130101'],
+                       [url2.rsplit('/', 1)[-1], 'http://' + url2, md5, 'MD5', '100', 'v20120101']])
+        code, output = self.run_step2('-b', 'search', '--tree-index', 'scan')
+        self.assertEqual(code, 0, output)
+        self.assertIn('older version on tree 1', output)
+        self.assertEqual(self.read_output('replica'), [path2])
+        self.assertEqual(self.read_output('to_download'), ['http://' + url1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+# Tests of the incremental update of the database written by CMIP5_replica_db.py
+#
+# Run from the repository directory with:
+#
+#    python -m unittest discover tests
+
+import os, sys, shutil, sqlite3, tempfile, subprocess, unittest
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+tree = '/g/data1/ua6/unofficial-ESG-replica/tmp/tree/aims3.llnl.gov/thredds/fileServer/cmip5_data/cmip5/output1/'
+ensemble = tree + 'NCAR/CCSM4/historical/mon/atmos/Amon/r1i1p1/'
+
+
+class ReplicaDbTest(unittest.TestCase):
+    ''' Update a database with file lists of tas_Amon_CCSM4_historical_r1i1p1 in different versions '''
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def update(self, versions):
+        ''' Write a file list with a file for each version, update the database with it and return its rows '''
+        listing = os.path.join(self.dir, 'paths.txt')
+        f = open(listing, 'w')
+        for v in versions:
+            f.write(ensemble + v + '/tas/tas_Amon_CCSM4_historical_r1i1p1_185001-185912.nc\n')
+        f.close()
+        cmd = [sys.executable, os.path.join(repo, 'CMIP5_replica_db.py'), '-v', 'tas', '-i', listing, '-o', 'test']
+        proc = subprocess.Popen(cmd, cwd=self.dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        self.assertEqual(proc.returncode, 0, output)
+        conn = sqlite3.connect(os.path.join(self.dir, 'test.db'))
+        rows = sorted(conn.execute("SELECT id, version, status FROM cmip5"))
+        conn.close()
+        return rows
+
+    def test_new_version_updates_row(self):
+        ''' A new version replaces the row of the old one, in place '''
+        self.assertEqual(self.update(['v20120101']), [(ensemble + 'v20120101/tas', 'v20120101', 'current')])
+        self.assertEqual(self.update(['v20130101']), [(ensemble + 'v20130101/tas', 'v20130101', 'current')])
+
+    def test_versions_side_by_side(self):
+        ''' A new version is added if the old one is still in the tree, and marked as removed when it goes '''
+        self.update(['v20120101'])
+        self.assertEqual(self.update(['v20120101', 'v20130101']),
+                         [(ensemble + 'v20120101/tas', 'v20120101', 'current'),
+                          (ensemble + 'v20130101/tas', 'v20130101', 'current')])
+        self.assertEqual(self.update(['v20130101']),
+                         [(ensemble + 'v20120101/tas', 'v20120101', 'removed'),
+                          (ensemble + 'v20130101/tas', 'v20130101', 'current')])
+
+
+if __name__ == '__main__':
+    unittest.main()